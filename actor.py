@@ -1,80 +1,130 @@
 #!/usr/bin/env python
+import time
 import torch
 import torch.multiprocessing as mp
 import random
 import numpy as np
 from collections import namedtuple
 from duelling_network import DuellingDQN
+from policy_network import PolicyNetwork
 from env import make_local_env
-import cv2
+from replay import pack_key
+from transport import SharedFrameRing
+from param_sync import SharedParameters
+from preprocessing import MaxPoolFrameSkip, ObservationPreprocessor
+from metrics import NullMetricsWriter
 
 Transition = namedtuple('Transition', ['S', 'A', 'R', 'Gamma', 'q'])
 N_Step_Transition = namedtuple('N_Step_Transition', ['S_t', 'A_t', 'R_ttpB', 'Gamma_ttpB', 'qS_t', 'S_tpn', 'qS_tpn', 'key'])
 
 
 class ExperienceBuffer(object):
-    def __init__(self, n, actor_id):
+    def __init__(self, n, actor_id, gamma=0.99):
         """
-        Implements a circular/ring buffer to store n-step transition data used by the actor
-        :param n:
+        Implements a circular/ring buffer to store n-step transition data used by the actor. Once the buffer holds n
+        single step transitions, every new transition completes the n-step transition of the oldest one, so one
+        n-step transition is emitted per step. The rewards are kept in a ring of their own so that the n-step return is
+        a single dot product with the precomputed discounts instead of a pass over all the entries on every step. Every
+        reward is written twice, n slots apart, so that the rewards of the entries in the ring are always a contiguous
+        slice starting at the head.
+        :param n: Number of steps (num_steps) of the n-step transitions
+        :param actor_id: Used to compose unique keys for the transitions and frames
+        :param gamma: Discount factor
         """
-        self.local_1step_buffer = list()  #  To store single step transitions to compose n-step transitions
+        self.local_1step_buffer = [None] * n  #  To store single step transitions to compose n-step transitions
         self.local_nstep_buffer= list()  #  To store n-step transitions b4 they r batched, prioritized and sent to replay mem
-        self.idx = -1
+        self.rewards = np.zeros(2 * n)  #  Rewards of the single step transitions. Indexed like local_1step_buffer
+        self.head = 0  #  Index of the oldest single step transition in the ring
+        self.num_1step_transitions = 0
         self.capacity = n
-        self.gamma = 0.99
+        self.gamma = gamma
+        self.discounts = gamma ** np.arange(n)
         self.id = actor_id
         self.n_step_seq_num = 0  # Used to compose the unique key per per-actor and per n-step transition stored
+        self.frame_seq_num = 0  # Used to compose the unique key per-actor and per observation frame stored
+        self.frames = dict()  # To store the observation frames that are not sent to the replay memory yet
 
-    def update_buffer(self):
+    def store_frame(self, frame):
         """
-        Updates the accumulated per-step discount and the partial return for every item in the buffer. This should be
-        called after every new transition is added to the buffer
+        Stores an observation frame so that the transitions can refer to it by its key instead of holding a copy of it.
+        Consecutive n-step transitions share their S_tpn and S_t frames and every frame is sent to the replay memory
+        only once.
+        :param frame: observation
+        :return: The unique key of the frame
+        """
+        key = pack_key(self.id, self.frame_seq_num)
+        self.frame_seq_num += 1
+        self.frames[key] = np.asarray(frame, dtype=np.uint8)
+        return key
+
+    def construct_nstep_transition(self, data, Gamma):
+        """
+        Constructs the n-step transition of the oldest single step transition in the buffer and removes it.
+        :param data: The transition at which the n-step transition bootstraps
+        :param Gamma: The discount of the bootstrap value
         :return: None
         """
-        for i in range(self.B - 1):
-            R = self.local_1step_buffer[i].R
-            Gamma = 1
-            for k in range(i + 1, self.B ):
-                Gamma *= self.gamma
-                R += Gamma * self.local_1step_buffer[k].R
-            self.local_1step_buffer[i] = Transition(self.local_1step_buffer[i].S,
-                                                    self.local_1step_buffer[i].A, R, Gamma,
-                                                    self.local_1step_buffer[i].q)
-    def construct_nstep_transition(self, data):
-        if self.idx == -1:  #  Episode ended at the very first step in this n-step transition
-            return
-        key = str(self.id) + str(self.n_step_seq_num)
-        n_step_transition = N_Step_Transition(*self.local_1step_buffer[0], data.S, data.q, key)
+        B = self.B
+        R = np.dot(self.discounts[:B], self.rewards[self.head: self.head + B])
+        oldest = self.local_1step_buffer[self.head]
+        key = pack_key(self.id, self.n_step_seq_num)
+        n_step_transition = N_Step_Transition(oldest.S, oldest.A, R, Gamma, oldest.q, data.S, data.q, key)
         self.n_step_seq_num += 1
         #  Put the n_step_transition into a local memory store
         self.local_nstep_buffer.append(n_step_transition)
-        #  Free-up the buffer
-        self.local_1step_buffer.clear()
-        #  Reset the memory index
-        self.idx = -1
+        #  Free-up the slot
+        self.local_1step_buffer[self.head] = None
+        self.head = (self.head + 1) % self.capacity
+        self.num_1step_transitions -= 1
 
     def add(self, data):
         """
-        Add transition data to the Experience Buffer and calls update_buffer
+        Add transition data to the Experience Buffer. If the buffer already holds n transitions, the n-step transition
+        of the oldest one is constructed with data as the bootstrap transition
         :param data: tuple containing a transition data of type Transition(s, a, r, gamma, q)
         :return: None
         """
-        if self.idx  + 1 < self.capacity:
-            self.idx += 1
-            self.local_1step_buffer.append(None)
-            self.local_1step_buffer[self.idx] = data
-            self.update_buffer()  #  calculate the accumulated per-step disc & partial return for all entries
-        else:  # single-step buffer has reached its capacity, n. Compute
-            #  Construct the n-step transition
-            self.construct_nstep_transition(data)
+        if self.B == self.capacity:
+            self.construct_nstep_transition(data, self.gamma ** self.capacity)
+        idx = (self.head + self.B) % self.capacity
+        self.local_1step_buffer[idx] = data
+        self.rewards[idx] = self.rewards[idx + self.capacity] = data.R
+        self.num_1step_transitions += 1
 
+    def flush(self, data):
+        """
+        Constructs the (partial) n-step transitions of all the single step transitions in the buffer when the episode
+        ends. The episode has terminated at data so the transitions do not bootstrap (Gamma is 0).
+        :param data: The terminal transition
+        :return: None
+        """
+        while self.B:
+            self.construct_nstep_transition(data, 0.0)
+        self.head = 0
 
     def get(self, batch_size):
+        """
+        Removes a batch of n-step transitions from the local n-step buffer along with the frames they refer to that
+        were not sent to the replay memory before.
+        :param batch_size: Number of n-step transitions
+        :return: list of N_Step_Transition whose S_t and S_tpn are frame keys and a dictionary of frame_key: frame
+        """
         assert batch_size <= self.size, "Requested n-step transitions batch size is more than available"
         batch_of_n_step_transitions = self.local_nstep_buffer[: batch_size]
         del self.local_nstep_buffer[: batch_size]
-        return batch_of_n_step_transitions
+        # Only the frames the batch refers to are sent. The replay memory keeps a frame as long as an experience refers
+        # to it, so later batches referring to the same frame find it there. The other frames stay in the buffer
+        # until a batch refers to them
+        keys = set(xp.S_t for xp in batch_of_n_step_transitions) | set(xp.S_tpn for xp in batch_of_n_step_transitions)
+        frames = {k: self.frames.pop(k) for k in sorted(keys) if k in self.frames}
+        # Frame keys increase monotonically. Frames older than the oldest frame that a pending transition or the
+        # current observation refers to are never sent
+        pending_keys = [xp.S_t for xp in self.local_nstep_buffer] + \
+                       [data.S for data in self.local_1step_buffer if data is not None]
+        oldest_needed_key = min(pending_keys) if pending_keys else pack_key(self.id, self.frame_seq_num - 1)
+        for k in [k for k in self.frames if k < oldest_needed_key]:
+            del self.frames[k]
+        return batch_of_n_step_transitions, frames
 
     @property
     def B(self):
@@ -82,7 +132,7 @@ class ExperienceBuffer(object):
         The current size of local single step buffer. B follows the same notation as in the Ape-X paper(TODO: insert link to paper)
         :return: The current size of the buffer
         """
-        return len(self.local_1step_buffer)
+        return self.num_1step_transitions
 
     @property
     def size(self):
@@ -94,7 +144,17 @@ class ExperienceBuffer(object):
 
 
 class Actor(mp.Process):
-    def __init__(self, actor_id, env_conf, shared_state, shared_replay_mem, actor_params):
+    def __init__(self, actor_id, env_conf, shared_state, shared_replay_mem, actor_params, inference_client=None,
+                 metrics=None):
+        """
+        An Actor process that gathers experience from num_envs_per_actor environment instances. The environments are
+        stepped in lock-step so that the Q-values for all of their observations are computed in a single batched
+        forward pass. Every environment has its own exploration epsilon and its own local experience buffer.
+        If an inference_client is given, the Q-values are computed by the InferenceServer and the Actor does not hold
+        a copy of the Q network.
+        The frames/sec, the experience sent to the replay memory and the staleness of the Q network parameters are
+        recorded by the metrics MetricsWriter, if given.
+        """
         super(Actor, self).__init__()
         self.actor_id = actor_id  # Used to compose a unique key for the transitions generated by each actor
         state_shape = tuple(env_conf['state_shape'])
@@ -102,93 +162,126 @@ class Actor(mp.Process):
         self.params = actor_params
         self.shared_state = shared_state
         self.T = self.params["T"]
-        self.Q = DuellingDQN(state_shape, action_dim)
-        self.Q.load_state_dict(shared_state["Q_state_dict"])
-        self.env = make_local_env(env_conf['name'])
+        self.inference_client = inference_client
+        self.metrics = metrics if metrics is not None else NullMetricsWriter()
+        if self.inference_client is None:
+            # The latest Q network parameters published by the Learner
+            self.shared_params = shared_state["Q_params"]
+            # fp32, TorchScript-traced or int8 quantized copy of the Q network depending on the policy_network param
+            self.Q = PolicyNetwork(state_shape, action_dim, self.params['policy_network'],
+                                   self.params['policy_min_action_agreement'])
+            self.param_version = self.Q.load(self.shared_params)
+        K = self.params['num_envs_per_actor']
+        self.envs = [MaxPoolFrameSkip(make_local_env(env_conf['name']), env_conf['frame_skip']) for _ in range(K)]
+        # Grey scale, resize and stack the frames of every environment into uint8 observations of shape state_shape
+        self.obs_preprocs = [ObservationPreprocessor(state_shape) for _ in range(K)]
         self.policy = self.epsilon_greedy_Q
-        self.local_experience_buffer = ExperienceBuffer(self.params["num_steps"], self.actor_id)
+        # The global index of an environment is used as the id of its buffer to keep the keys unique across actors
+        self.local_experience_buffers = [ExperienceBuffer(self.params["num_steps"], self.actor_id * K + k,
+                                                          self.params['gamma']) for k in range(K)]
         self.global_replay_queue = shared_replay_mem
+        # Frames are passed to the replay memory through shared memory. Only descriptors go through the replay queue
+        self.frame_ring = SharedFrameRing(state_shape, self.params['shared_frame_ring_capacity'])
         eps = self.params['epsilon']
-        N = self.params['num_actors']
+        N = self.params['num_actors'] * K
         alpha = self.params['alpha']
-        self.epsilon = eps**(1 + alpha * self.actor_id / (N-1))
+        self.epsilons = [eps**(1 + alpha * (self.actor_id * K + k) / max(N - 1, 1)) for k in range(K)]
         self.gamma = self.params['gamma']
         self.num_buffered_steps = 0  # Used to compose a unique key for the transitions generated by each actor
-        self.rgb2gray = lambda x: np.dot(x, np.array([[0.299, 0.587, 0.114]]).T)  # RGB to Gray scale
-        self.torch_shape = lambda x: np.reshape(self.rgb2gray(x), (1, x.shape[1], x.shape[0]))  # WxHxC to CxWxH
-        self.obs_preproc = lambda x: np.resize(self.torch_shape(x), state_shape)
 
-    def epsilon_greedy_Q(self, qS_t):
-        if random.random() >= self.epsilon:
+    def epsilon_greedy_Q(self, qS_t, epsilon):
+        if random.random() >= epsilon:
             return np.argmax(qS_t)
         else:
             return random.choice(list(range(len(qS_t))))
 
     def compute_priorities(self, n_step_transitions):
+        """
+        Computes the absolute n-step TD errors of a batch of n-step transitions in one vectorized pass
+        :param n_step_transitions: list of N_Step_Transition
+        :return: numpy array with the priority of every transition in n_step_transitions
+        """
         n_step_transitions = N_Step_Transition(*zip(*n_step_transitions))
         # Convert tuple to numpy array
         rew_t_to_tpB = np.array(n_step_transitions.R_ttpB)
         gamma_t_to_tpB = np.array(n_step_transitions.Gamma_ttpB)
         qS_tpn = np.array(n_step_transitions.qS_tpn)
-        A_t = np.array(n_step_transitions.A_t, dtype=np.int)
+        A_t = np.array(n_step_transitions.A_t, dtype=np.int64)
         qS_t = np.array(n_step_transitions.qS_t)
 
-        #print("np.max(qS_tpn,1):", np.max(qS_tpn, 1))
         #  Calculate the absolute n-step TD errors
-        n_step_td_target =  rew_t_to_tpB + gamma_t_to_tpB * np.max(qS_tpn, 1)
-        #print("td_target:", n_step_td_target)
-        n_step_td_error = n_step_td_target - np.array([ qS_t[i, A_t[i]] for i in range(A_t.shape[0])])
-        #print("td_err:", n_step_td_error)
-        priorities = {k: val for k in n_step_transitions.key for val in abs(n_step_td_error) }
-        return priorities
-
+        n_step_td_target = rew_t_to_tpB + gamma_t_to_tpB * np.max(qS_tpn, 1)
+        n_step_td_error = n_step_td_target - qS_t[np.arange(A_t.shape[0]), A_t]
+        return np.abs(n_step_td_error).astype(np.float32)
 
     def run(self):
         """
-        A method to gather experiences using the Actor's policy and the Actor's environment instance.
+        A method to gather experiences using the Actor's policy and the Actor's environment instances.
           - Periodically syncs the parameters of the Q network used by the Actor with the latest Q parameters made available by
             the Learner process.
-          - Stores the single step transitions and the n-step transitions in a local experience buffer
+          - Stores the single step transitions and the n-step transitions in a local experience buffer per environment
           - Periodically flushes the n-step transition experiences to the global replay queue
-        :param T: The total number of time steps to gather experience
+        :param T: The total number of time steps to gather experience. Every time step steps all the environments
         :return:
         """
         # 3. Get initial state from environment
-        obs = self.obs_preproc(self.env.reset())
-        ep_reward = []
+        obs = [obs_preproc.reset(env.reset()) for env, obs_preproc in zip(self.envs, self.obs_preprocs)]
+        obs_keys = [buffer.store_frame(o) for buffer, o in zip(self.local_experience_buffers, obs)]
+        ep_rewards = [[] for _ in self.envs]
+        last_print_time, last_print_t = time.time(), 0
         for t in range(self.T):
-            with torch.no_grad():
-                qS_t = self.Q(torch.from_numpy(obs).unsqueeze(0).float())[2].squeeze().numpy()
-            # 5. Select the action using the current policy
-            action = self.policy(qS_t)
-            # 6. Apply action in the environment
-            next_obs, reward, done, _ = self.env.step(action)
-            # 7. Add data to local buffer
-            self.local_experience_buffer.add(Transition(obs, action, reward , self.gamma, qS_t))
-            obs = self.obs_preproc(next_obs)
-            ep_reward.append(reward)
-            print("Actor#", self.actor_id, "t=", t, "action=", action, "reward:", reward, "1stp_buf_size:", self.local_experience_buffer.B, end='\r')
-
-            if done:  # Not mentioned in the paper's algorithm
-                # Truncate the n-step transition as the episode has ended; NOTE: Reward is set to 0
-                self.local_experience_buffer.construct_nstep_transition(Transition(obs, action, 0, self.gamma, qS_t))
-                # Reset the environment
-                obs = self.obs_preproc(self.env.reset())
-                print("Actor#:", self.actor_id, "t:", t, "  ep_len:", len(ep_reward), "  ep_reward:", np.sum(ep_reward))
-                ep_reward = []
-
-            # 8. Periodically send data to replay
-            if self.local_experience_buffer.size >= self.params['n_step_transition_batch_size']:
-                # 9. Get batches of multi-step transitions
-                n_step_experience_batch = self.local_experience_buffer.get(self.params['n_step_transition_batch_size'])
-                # 10.Calculate the priorities for experience
-                priorities = self.compute_priorities(n_step_experience_batch)
-                # 11. Send the experience to the global replay memory
-                self.global_replay_queue.put([priorities, n_step_experience_batch])
-
-            if t % self.params['Q_network_sync_freq'] == 0:
-                # 13. Obtain latest network parameters
-                self.Q.load_state_dict(self.shared_state["Q_state_dict"])
+            # 4. Compute the Q-values of the observations from all the environments in one batch
+            if self.inference_client is None:
+                qS = self.Q(torch.from_numpy(np.stack(obs)).float())
+            else:
+                _, qS = self.inference_client.evaluate(np.stack(obs))
+            for k, (env, buffer) in enumerate(zip(self.envs, self.local_experience_buffers)):
+                qS_t = qS[k]
+                # 5. Select the action using the current policy
+                action = self.policy(qS_t, self.epsilons[k])
+                # 6. Apply action in the environment
+                next_obs, reward, done, _ = env.step(action)
+                # 7. Add data to local buffer
+                buffer.add(Transition(obs_keys[k], action, reward , self.gamma, qS_t))
+                obs[k] = self.obs_preprocs[k](next_obs)
+                obs_keys[k] = buffer.store_frame(obs[k])
+                ep_rewards[k].append(reward)
+
+                if done:  # Not mentioned in the paper's algorithm
+                    # Truncate the n-step transitions as the episode has ended; NOTE: Reward is set to 0
+                    buffer.flush(Transition(obs_keys[k], action, 0, self.gamma, qS_t))
+                    # Reset the environment
+                    obs[k] = self.obs_preprocs[k].reset(env.reset())
+                    obs_keys[k] = buffer.store_frame(obs[k])
+                    print("Actor#:", self.actor_id, "env#:", k, "t:", t, "  ep_len:", len(ep_rewards[k]),
+                          "  ep_reward:", np.sum(ep_rewards[k]))
+                    ep_rewards[k] = []
+                    self.metrics.add("actor_episodes")
+
+                # 8. Periodically send data to replay
+                if buffer.size >= self.params['n_step_transition_batch_size']:
+                    # 9. Get batches of multi-step transitions
+                    n_step_experience_batch, frames = buffer.get(self.params['n_step_transition_batch_size'])
+                    # 10.Calculate the priorities for experience
+                    priorities = self.compute_priorities(n_step_experience_batch)
+                    # 11. Send the experience along with the new frames it refers to, to the global replay memory
+                    start = self.frame_ring.put(list(frames.values()))
+                    self.global_replay_queue.put([priorities, n_step_experience_batch, list(frames.keys()),
+                                                  self.frame_ring.spec, start])
+                    self.metrics.add("actor_transitions", len(n_step_experience_batch))
+                    self.metrics.add("actor_bytes", sum(frame.nbytes for frame in frames.values()))
+            self.metrics.add("actor_frames", len(self.envs))
+            # The status is printed at most once every print_interval seconds
+            if time.time() - last_print_time >= self.params['print_interval']:
+                print("Actor#", self.actor_id, "t=", t, "frames/sec:",
+                      len(self.envs) * (t - last_print_t) / (time.time() - last_print_time), "1stp_buf_sizes:",
+                      [buffer.B for buffer in self.local_experience_buffers])
+                last_print_time, last_print_t = time.time(), t
+
+            if self.inference_client is None and t % self.params['Q_network_sync_freq'] == 0:
+                # 13. Obtain latest network parameters. Skipped if the Learner has not published new parameters
+                self.metrics.set("param_staleness", self.shared_params.version - self.param_version)
+                self.param_version = self.Q.load(self.shared_params, self.param_version)
 
 if __name__ == "__main__":
     """ 
@@ -196,26 +289,37 @@ if __name__ == "__main__":
     """
     env_conf = {"state_shape": (1, 84, 84),
                 "action_dim": 4,
-                "name": "Breakout-v0"}
+                "name": "BreakoutNoFrameskip-v4",
+                "frame_skip": 4}
     params= {"local_experience_buffer_capacity": 10,
              "epsilon": 0.4,
              "alpha": 7,
              "gamma": 0.99,
              "num_actors": 2,
+             "num_envs_per_actor": 1,
              "n_step_transition_batch_size": 5,
              "Q_network_sync_freq": 10,
+             "policy_network": "traced",
+             "policy_min_action_agreement": 0.9,
+             "print_interval": 1,
              "num_steps": 3,
+             "shared_frame_ring_capacity": 1000,
              "T": 101 # Total number of time steps to gather experience
 
              }
     dummy_q = DuellingDQN(env_conf['state_shape'], env_conf['action_dim'])
     mp_manager = mp.Manager()
     shared_state = mp_manager.dict()
-    shared_state["Q_state_dict"] = dummy_q.state_dict()
+    shared_params = SharedParameters(dummy_q)
+    shared_params.publish(dummy_q)
+    shared_state["Q_params"] = shared_params
     shared_replay_mem = mp_manager.Queue()
     actor = Actor(1, env_conf, shared_state, shared_replay_mem, params)
     actor.run()
     print("Main: replay_mem.size:", shared_replay_mem.qsize())
     for i in range(shared_replay_mem.qsize()):
-        p, xp_batch = shared_replay_mem.get()
+        p, xp_batch, frame_keys, ring_spec, start = shared_replay_mem.get()
         print("priority:", p)
+    actor.frame_ring.close()
+    actor.frame_ring.unlink()
+    shared_params.unlink()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Runs the end-to-end benchmark suite (see benchmarks/suite.py) on the SyntheticEnv for every combination of the number
+of Actors, replay memory capacity and batch size that a component depends on. The results are printed and written as
+JSON to --output. With --baseline, every measurement is compared against the matching one of an earlier --output and
+the exit status is non-zero if any throughput dropped, or the peak memory grew, by more than --tolerance.
+Run from the root of the repository using:
+`python -m benchmarks --output results.json`
+"""
+import os
+import sys
+import json
+import time
+import platform
+import itertools
+import subprocess
+import torch
+from argparse import ArgumentParser
+from benchmarks import suite
+
+
+def configurations(args):
+    """
+    :return: list of (component, configuration) pairs to benchmark
+    """
+    grid = {"experience_buffer": [dict()],
+            "actor": [{"num_actors": n} for n in args.num_actors],
+            "replay": [{"capacity": c, "batch_size": b} for c, b in itertools.product(args.capacities, args.batch_sizes)],
+            "learner": [{"capacity": c, "batch_size": b} for c, b in itertools.product(args.capacities,
+                                                                                       args.batch_sizes)],
+            "end_to_end": [{"num_actors": n, "capacity": c, "batch_size": b}
+                           for n, c, b in itertools.product(args.num_actors, args.capacities, args.batch_sizes)]}
+    return [(component, config) for component in args.components for config in grid[component]]
+
+
+def run(params, args, component, config):
+    if component == "experience_buffer":
+        return suite.run_isolated(suite.experience_buffer, params, args.env_name, args.buffer_steps)
+    if component == "actor":
+        return suite.run_isolated(suite.actor, params, args.env_name, config["num_actors"], args.actor_steps)
+    if component == "replay":
+        return suite.run_isolated(suite.replay, params, args.env_name, config["capacity"], config["batch_size"],
+                                  args.seconds)
+    if component == "learner":
+        return suite.run_isolated(suite.learner, params, args.env_name, config["capacity"], config["batch_size"],
+                                  args.learner_updates)
+    return suite.run_isolated(suite.end_to_end, params, args.env_name, config["num_actors"], config["capacity"],
+                              config["batch_size"], args.min_replay_mem_size, args.seconds)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the measurements of results with the ones of the same component and configuration in baseline. The
+    throughputs (*_per_sec) regress when they are lower and the peak memory when it is higher
+    :return: list of the regressions as (component, config, measurement, baseline value, value)
+    """
+    baseline_results = {(r["component"], json.dumps(r["config"], sort_keys=True)): r for r in baseline["results"]}
+    regressions = []
+    for result in results:
+        baseline_result = baseline_results.get((result["component"], json.dumps(result["config"], sort_keys=True)))
+        if baseline_result is None:
+            continue
+        for name, value in result["measurements"].items():
+            if name not in baseline_result["measurements"]:
+                continue
+            baseline_value = baseline_result["measurements"][name]
+            if (name.endswith("_per_sec") and value < (1 - tolerance) * baseline_value) or \
+                    (name == "peak_rss_mb" and value > (1 + tolerance) * baseline_value):
+                regressions.append((result["component"], result["config"], name, baseline_value, value))
+    return regressions
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks")
+    arg_parser.add_argument("--params-file", default="parameters.json", type=str,
+                            help="Parameters of the benchmarked components. The benchmarked values are overridden")
+    arg_parser.add_argument("--components", default=list(suite.COMPONENTS), choices=suite.COMPONENTS, nargs='+')
+    arg_parser.add_argument("--env-name", default="Synthetic-v0", type=str,
+                            help="Synthetic-v0 or Synthetic-<step cost>us-v0 to emulate the cost of the emulator")
+    arg_parser.add_argument("--num-actors", default=[1, 2], type=int, nargs='+')
+    arg_parser.add_argument("--capacities", default=[10000, 100000], type=int, nargs='+',
+                            help="soft_capacity of the replay memory")
+    arg_parser.add_argument("--batch-sizes", default=[32, 128], type=int, nargs='+', help="replay_sample_size")
+    arg_parser.add_argument("--seconds", default=10.0, type=float,
+                            help="Duration of the replay sampling and end-to-end measurements")
+    arg_parser.add_argument("--buffer-steps", default=20000, type=int, help="Number of ExperienceBuffer steps")
+    arg_parser.add_argument("--actor-steps", default=500, type=int, help="Number of time steps per Actor")
+    arg_parser.add_argument("--learner-updates", default=200, type=int, help="Number of Learner updates")
+    arg_parser.add_argument("--min-replay-mem-size", default=2000, type=int,
+                            help="Replay memory size at which the end-to-end Learner starts, at most half the capacity")
+    arg_parser.add_argument("--output", default=None, type=str, help="Path of the JSON results")
+    arg_parser.add_argument("--baseline", default=None, type=str, help="Path of JSON results to compare against")
+    arg_parser.add_argument("--tolerance", default=0.1, type=float, help="Relative change reported as a regression")
+    args = arg_parser.parse_args()
+    params = json.load(open(args.params_file, 'r'))
+
+    results = []
+    for component, config in configurations(args):
+        measurements = run(params, args, component, config)
+        results.append({"component": component, "config": config, "measurements": measurements})
+        print("{:<18} {:<50} {}".format(component, json.dumps(config),
+                                        " ".join("{}={:.1f}".format(k, v) for k, v in measurements.items())))
+
+    report = {"time": time.time(), "commit": git_commit(), "platform": platform.platform(),
+              "python": platform.python_version(), "torch": torch.__version__, "num_cpus": os.cpu_count(),
+              "args": vars(args), "results": results}
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+
+    if args.baseline:
+        regressions = compare(results, json.load(open(args.baseline, 'r')), args.tolerance)
+        for component, config, name, baseline_value, value in regressions:
+            print("REGRESSION {} {} {}: {:.1f} -> {:.1f}".format(component, json.dumps(config), name, baseline_value,
+                                                                 value))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Checks and benchmarks the n-step return accumulation of the Actor's ExperienceBuffer.
+The n-step transitions of the ring buffer are checked against a brute-force n-step return computation and against the
+nested loop ExperienceBuffer that it replaced on random reward sequences and episode lengths. The nested loop buffer
+over-counts the partial returns for num_steps > 2, so it is only compared for num_steps <= 2. The transitions and frames
+of the ring buffer are also fed into a ReplayMemory to check that none of them is lost. The per-step cost of the
+two is then compared for different num_steps.
+Run from the root of the repository using:
+`python -m benchmarks.experience_buffer`
+"""
+import time
+import random
+import numpy as np
+from argparse import ArgumentParser
+from actor import ExperienceBuffer, Transition, N_Step_Transition
+from replay import ReplayMemory
+
+
+class LegacyExperienceBuffer(object):
+    """
+    The nested loop ExperienceBuffer that the ring buffer replaced. Kept here only as a baseline
+    """
+    def __init__(self, n, actor_id, gamma=0.99):
+        self.local_1step_buffer = list()
+        self.local_nstep_buffer = list()
+        self.idx = -1
+        self.capacity = n
+        self.gamma = gamma
+        self.id = actor_id
+        self.n_step_seq_num = 0
+
+    def update_buffer(self):
+        for i in range(len(self.local_1step_buffer) - 1):
+            R = self.local_1step_buffer[i].R
+            Gamma = 1
+            for k in range(i + 1, len(self.local_1step_buffer)):
+                Gamma *= self.gamma
+                R += Gamma * self.local_1step_buffer[k].R
+            self.local_1step_buffer[i] = Transition(self.local_1step_buffer[i].S,
+                                                    self.local_1step_buffer[i].A, R, Gamma,
+                                                    self.local_1step_buffer[i].q)
+
+    def construct_nstep_transition(self, data):
+        if self.idx == -1:
+            return
+        key = str(self.id) + str(self.n_step_seq_num)
+        n_step_transition = N_Step_Transition(*self.local_1step_buffer[0], data.S, data.q, key)
+        self.n_step_seq_num += 1
+        self.local_nstep_buffer.append(n_step_transition)
+        self.local_1step_buffer.clear()
+        self.idx = -1
+
+    def add(self, data):
+        if self.idx + 1 < self.capacity:
+            self.idx += 1
+            self.local_1step_buffer.append(data)
+            self.update_buffer()
+        else:
+            self.construct_nstep_transition(data)
+            self.add(data)
+
+
+def run_episodes(buffer, flush, rewards, episode_ends):
+    """
+    Feeds the rewards to the buffer. The observation key of step t is t and episode_ends holds the steps at which the
+    episodes terminate
+    """
+    for t, r in enumerate(rewards):
+        buffer.add(Transition(t, 0, r, buffer.gamma, None))
+        if t in episode_ends:
+            flush(Transition(t + 1, 0, 0, buffer.gamma, None))
+    return buffer.local_nstep_buffer
+
+
+def check(num_trials, max_n, gamma=0.99):
+    for _ in range(num_trials):
+        n = random.randint(1, max_n)
+        rewards = np.random.randn(random.randint(1, 200))
+        episode_ends = set(np.flatnonzero(np.random.uniform(size=len(rewards)) < 0.05))
+        episode_ends.add(len(rewards) - 1)
+        buffer = ExperienceBuffer(n, 0, gamma)
+        n_step_transitions = run_episodes(buffer, buffer.flush, rewards, episode_ends)
+
+        # One n-step transition per step, checked against a brute-force n-step return
+        assert len(n_step_transitions) == len(rewards)
+        for t, xp in enumerate(n_step_transitions):
+            episode_end = min(e for e in episode_ends if e >= t)
+            end = min(t + n, episode_end + 1)
+            assert xp.S_t == t and xp.S_tpn == end
+            assert np.isclose(xp.R_ttpB, sum(gamma ** k * rewards[t + k] for k in range(end - t)))
+            assert xp.Gamma_ttpB == (0.0 if end == episode_end + 1 else gamma ** n)
+
+        # The n-step transitions of the nested loop buffer are a subset with the same returns. The nested loop adds the
+        # already accumulated partial returns again on every step, so its returns are only correct for n <= 2
+        if n > 2:
+            continue
+        legacy_buffer = LegacyExperienceBuffer(n, 0, gamma)
+        by_S_t = {xp.S_t: xp for xp in n_step_transitions}
+        for legacy_xp in run_episodes(legacy_buffer, legacy_buffer.construct_nstep_transition, rewards, episode_ends):
+            xp = by_S_t[legacy_xp.S_t]
+            assert xp.S_tpn == legacy_xp.S_tpn and np.isclose(xp.R_ttpB, legacy_xp.R_ttpB)
+    print("ExperienceBuffer: {} random trials passed".format(num_trials))
+
+
+def check_replay(num_steps_list, steps=3000, batch_size=5, episode_length=37):
+    """
+    Feeds the n-step transitions and frames of an ExperienceBuffer into a ReplayMemory, with and without episode ends,
+    and checks that every transition is stored and that the buffer does not hold on to the frames it sent
+    """
+    for n in num_steps_list:
+        for episode_ends in [True, False]:
+            replay_mem = ReplayMemory(10 * steps, {"priority_exponent": 0.6, "importance_sampling_exponent": 0.4,
+                                                   "frame_compression": None})
+            buffer = ExperienceBuffer(n, 0)
+            q = np.zeros(4, dtype=np.float32)
+            num_sent = 0
+            obs_key = buffer.store_frame(np.full((1, 8, 8), 0, dtype=np.uint8))
+            for t in range(steps):
+                buffer.add(Transition(obs_key, 0, 1.0, buffer.gamma, q))
+                obs_key = buffer.store_frame(np.full((1, 8, 8), t % 256, dtype=np.uint8))
+                if episode_ends and t % episode_length == episode_length - 1:
+                    buffer.flush(Transition(obs_key, 0, 0, buffer.gamma, q))
+                    obs_key = buffer.store_frame(np.full((1, 8, 8), 0, dtype=np.uint8))
+                while buffer.size >= batch_size:
+                    xp_batch, frames = buffer.get(batch_size)
+                    replay_mem.add(np.ones(len(xp_batch)), xp_batch, frames)
+                    num_sent += len(xp_batch)
+            assert replay_mem.size() == num_sent, "{} of {} transitions stored".format(replay_mem.size(), num_sent)
+            assert len(buffer.frames) <= n + batch_size + 1
+    print("ExperienceBuffer -> ReplayMemory: every transition stored")
+
+
+def time_per_step(buffer_class, n, num_steps):
+    buffer = buffer_class(n, 0)
+    start = time.perf_counter()
+    for t in range(num_steps):
+        buffer.add(Transition(t, 0, 1.0, buffer.gamma, None))
+        if len(buffer.local_nstep_buffer) >= 5:
+            del buffer.local_nstep_buffer[:]
+    return (time.perf_counter() - start) / num_steps
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.experience_buffer")
+    arg_parser.add_argument("--num-trials", default=500, type=int, help="Number of random property checks")
+    arg_parser.add_argument("--num-steps", default=[3, 5, 10, 20, 50], type=int, nargs='+')
+    arg_parser.add_argument("--steps", default=20000, type=int, help="Number of steps timed per configuration")
+    args = arg_parser.parse_args()
+
+    check(args.num_trials, max(args.num_steps))
+    check_replay(args.num_steps)
+    print("{:>10} {:>16} {:>16}".format("num_steps", "ring (us/step)", "legacy (us/step)"))
+    for n in args.num_steps:
+        print("{:>10} {:>16.2f} {:>16.2f}".format(n, 1e6 * time_per_step(ExperienceBuffer, n, args.steps),
+                                                  1e6 * time_per_step(LegacyExperienceBuffer, n, args.steps)))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+"""
+Memory versus sample latency of the replay memory with raw and compressed frames.
+Checks the LRU cache of the compressed frames and then fills a ReplayMemory of every capacity with synthetic
+experience, each in a fresh process, and reports the memory taken by the frames, the resident memory of the process,
+the insert cost and the sample latency. The priorities follow a heavy-tailed distribution so that, like the TD errors,
+a few experiences are sampled much more often than the others.
+The raw frames of the larger capacities do not fit in the RAM of most machines. Their footprint is only estimated.
+Run from the root of the repository using:
+`python -m benchmarks.frame_compression`
+"""
+import os
+import time
+import numpy as np
+import torch.multiprocessing as mp
+from argparse import ArgumentParser
+from replay import ReplayMemory, CompressedFramePool
+from benchmarks.replay_snapshot import FRAME_SHAPE, fill
+from benchmarks.suite import resident_memory
+
+
+def heavy_tailed_priorities(size):
+    return np.random.pareto(1.0, size=size)
+
+
+def check_cache(codec):
+    """
+    Reads batches of random sizes, some larger than the LRU cache and some smaller than the eighth of it that is
+    evicted at once, and checks them against the stored frames
+    """
+    frame_pool = CompressedFramePool((4, 4), 200, codec, 2, 80)
+    frames = np.random.randint(0, 255, (200, 4, 4), dtype=np.uint8)
+    frame_pool.store(np.arange(200), frames)
+    for slots in [np.arange(5), np.arange(10, 88)] + [np.random.randint(0, 200, np.random.randint(1, 120))
+                                                        for _ in range(200)]:
+        assert np.array_equal(frame_pool.get(slots), frames[slots])
+    print("CompressedFramePool ({}): cached reads match the stored frames".format(codec))
+
+
+def benchmark(capacity, codec, params, batch_size, num_samples, results):
+    params = dict(params, frame_compression=codec)
+    replay_mem = ReplayMemory(capacity, params)
+    rss = resident_memory(os.getpid())
+    start = time.perf_counter()
+    fill(replay_mem, capacity, priorities=heavy_tailed_priorities, num_distinct_frames=1000)
+    insert_time = (time.perf_counter() - start) / capacity
+    latencies = []
+    for _ in range(num_samples):
+        start = time.perf_counter()
+        replay_mem.sample(batch_size)
+        latencies.append(time.perf_counter() - start)
+    results.put((replay_mem.frame_pool.nbytes(), resident_memory(os.getpid()) - rss, insert_time,
+                 np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.frame_compression")
+    arg_parser.add_argument("--capacities", default=[100000, 1000000, 2000000], type=int, nargs='+',
+                            help="soft_capacity of the replay memory")
+    arg_parser.add_argument("--codecs", default=["raw", "lz4"], type=str, nargs='+',
+                            help="raw or the frame_compression codec")
+    arg_parser.add_argument("--decompression-threads", default=4, type=int)
+    arg_parser.add_argument("--frame-cache-size", default=20000, type=int)
+    arg_parser.add_argument("--batch-size", default=32, type=int, help="replay_sample_size")
+    arg_parser.add_argument("--num-samples", default=2000, type=int)
+    arg_parser.add_argument("--max-raw-gb", default=2.0, type=float,
+                            help="Largest raw frame footprint that is benchmarked instead of estimated")
+    args = arg_parser.parse_args()
+    params = {"priority_exponent": 0.6, "importance_sampling_exponent": 0.4,
+              "decompression_threads": args.decompression_threads, "frame_cache_size": args.frame_cache_size}
+    frame_size = np.prod(FRAME_SHAPE)
+    for codec in args.codecs:
+        if codec != "raw":
+            check_cache(codec)
+
+    print("{:>10} {:>6} {:>12} {:>10} {:>12} {:>10} {:>10}".format("capacity", "codec", "frames (MB)", "RSS (MB)",
+                                                                     "insert (us)", "p50 (ms)", "p99 (ms)"))
+    for capacity in args.capacities:
+        for codec in args.codecs:
+            # Like the ReplayMemory's FramePool, the estimate includes the 1/8 extra frame slots
+            raw_bytes = (capacity + capacity // 8) * frame_size
+            if codec == "raw" and raw_bytes > args.max_raw_gb * 2 ** 30:
+                print("{:>10} {:>6} {:>12.1f} {:>10} {:>12} {:>10} {:>10}".format(
+                    capacity, codec, raw_bytes / 2 ** 20, "estimate", "-", "-", "-"))
+                continue
+            results = mp.Queue()
+            proc = mp.Process(target=benchmark, args=(capacity, None if codec == "raw" else codec, params,
+                                                      args.batch_size, args.num_samples, results))
+            proc.start()
+            frame_bytes, rss, insert_time, p50, p99 = results.get()
+            proc.join()
+            print("{:>10} {:>6} {:>12.1f} {:>10.1f} {:>12.2f} {:>10.3f} {:>10.3f}".format(
+                capacity, codec, frame_bytes / 2 ** 20, rss / 2 ** 20, 1e6 * insert_time, 1e3 * p50, 1e3 * p99))
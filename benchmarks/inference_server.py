@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+Benchmark of the Q-value evaluation throughput and latency of the Actors as the number of Actors grows.
+Compares every Actor evaluating its own copy of the Q network with the Actors sending their observations to the
+batching InferenceServer.
+Run from the root of the repository using:
+`python -m benchmarks.inference_server`
+"""
+import time
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from argparse import ArgumentParser
+from duelling_network import DuellingDQN
+from inference_server import InferenceServer
+from param_sync import SharedParameters
+
+ENV_CONF = {"state_shape": (1, 84, 84), "action_dim": 4}
+
+
+def local_client(num_requests, obs_per_request, state_dict):
+    Q = DuellingDQN(ENV_CONF['state_shape'], ENV_CONF['action_dim'])
+    Q.load_state_dict(state_dict)
+    obs = np.random.randint(0, 255, (obs_per_request,) + ENV_CONF['state_shape'], dtype=np.uint8)
+    for _ in range(num_requests):
+        with torch.no_grad():
+            Q(torch.from_numpy(obs).float())
+
+
+def server_client(client, num_requests, obs_per_request):
+    obs = np.random.randint(0, 255, (obs_per_request,) + ENV_CONF['state_shape'], dtype=np.uint8)
+    for _ in range(num_requests):
+        client.evaluate(obs)
+
+
+def benchmark(mode, num_actors, num_requests, obs_per_request, server_params):
+    """
+    :return: Observations evaluated per second across all the Actors and the inference server stats
+    """
+    Q = DuellingDQN(ENV_CONF['state_shape'], ENV_CONF['action_dim'])
+    state_dict = Q.state_dict()
+    stats = None
+    if mode == "local":
+        procs = [mp.Process(target=local_client, args=(num_requests, obs_per_request, state_dict))
+                 for _ in range(num_actors)]
+    else:
+        shared_params = SharedParameters(Q)
+        shared_params.publish(Q)
+        server = InferenceServer(ENV_CONF, {"Q_params": shared_params}, server_params, num_actors)
+        server.start()
+        procs = [mp.Process(target=server_client, args=(server.client(i), num_requests, obs_per_request))
+                 for i in range(num_actors)]
+    start_time = time.perf_counter()
+    [proc.start() for proc in procs]
+    [proc.join() for proc in procs]
+    elapsed = time.perf_counter() - start_time
+    if mode == "server":
+        stats = server.stats()
+        server.terminate()
+        shared_params.unlink()
+    return num_actors * num_requests * obs_per_request / elapsed, stats
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.inference_server")
+    arg_parser.add_argument("--num-actors", default=[1, 2, 4, 8, 16], type=int, nargs='+')
+    arg_parser.add_argument("--num-requests", default=200, type=int, help="Number of requests sent by each actor")
+    arg_parser.add_argument("--obs-per-request", default=1, type=int, help="num_envs_per_actor")
+    arg_parser.add_argument("--max-batch-size", default=64, type=int)
+    arg_parser.add_argument("--max-wait-ms", default=2, type=float)
+    arg_parser.add_argument("--policy-network", default="eager", type=str, help="eager, traced or quantized")
+    args = arg_parser.parse_args()
+    server_params = {"max_batch_size": args.max_batch_size, "max_wait_ms": args.max_wait_ms,
+                     "Q_network_sync_freq": 10 ** 9, "policy_network": args.policy_network,
+                     "policy_min_action_agreement": 0.9}
+
+    print("{:>7} {:>8} {:>12} {:>12} {:>16} {:>16}".format("actors", "mode", "obs/sec", "batch size",
+                                                           "latency (ms)", "forward (ms)"))
+    for num_actors in args.num_actors:
+        for mode in ["local", "server"]:
+            throughput, stats = benchmark(mode, num_actors, args.num_requests, args.obs_per_request, server_params)
+            if stats is None:
+                print("{:>7} {:>8} {:>12.1f} {:>12} {:>16} {:>16}".format(num_actors, mode, throughput, "-", "-", "-"))
+            else:
+                print("{:>7} {:>8} {:>12.1f} {:>12.1f} {:>16.3f} {:>16.3f}".format(
+                    num_actors, mode, throughput, stats["mean_batch_size"], stats["mean_latency_ms"],
+                    stats["mean_forward_ms"]))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Checks and benchmarks the double-Q loss computation of the Learner.
+Compares the previous path, which runs three forward passes with gradients enabled on the inputs, against the current
+path with inference mode double-Q targets, with S_t and S_tpn in separate forward passes and in one concatenated
+(fused_forward) forward pass. The losses and priorities of the three are checked to match and then the updates/sec and
+samples/sec of the forward + backward + optimizer step are measured for different batch sizes and numbers of threads.
+Run from the root of the repository using:
+`python -m benchmarks.learner_forward`
+"""
+import json
+import time
+import numpy as np
+import torch
+from argparse import ArgumentParser
+from learner import Learner
+from replay import N_Step_Transition
+
+
+def legacy_loss_and_priorities(learner, xp_batch, is_weights):
+    """
+    The Learner.compute_loss_and_priorities that the current one replaced. Kept here only as a baseline
+    """
+    S_t = xp_batch.S_t.requires_grad_(True)
+    S_tpn = xp_batch.S_tpn.requires_grad_(True)
+    with torch.no_grad():
+        G_t = xp_batch.R_ttpB + xp_batch.Gamma_ttpB * \
+              learner.Q_double(S_tpn)[2].gather(1, torch.argmax(learner.Q(S_tpn)[2], 1).view(-1, 1)).squeeze()
+    Q_S_A = learner.Q(S_t)[2].gather(1, xp_batch.A_t.reshape(-1, 1)).squeeze()
+    batch_td_error = G_t.float() - Q_S_A
+    loss = 1/2 * is_weights * (batch_td_error)**2
+    return loss.mean(), np.abs(batch_td_error.detach().numpy())
+
+
+def synthetic_batch(batch_size, state_shape, action_dim):
+    S_t = torch.randint(0, 256, (batch_size,) + tuple(state_shape), dtype=torch.uint8).float()
+    S_tpn = torch.randint(0, 256, (batch_size,) + tuple(state_shape), dtype=torch.uint8).float()
+    xp_batch = N_Step_Transition(S_t, torch.randint(0, action_dim, (batch_size,)), torch.rand(batch_size),
+                                 torch.full((batch_size,), 0.99 ** 3), torch.rand(batch_size, action_dim), S_tpn,
+                                 torch.rand(batch_size, action_dim), np.arange(batch_size))
+    return xp_batch, torch.rand(batch_size)
+
+
+def copy_batch(xp_batch):
+    # The legacy path sets requires_grad on the observations, so every update gets fresh tensors
+    return xp_batch._replace(S_t=xp_batch.S_t.clone(), S_tpn=xp_batch.S_tpn.clone())
+
+
+def check(learner, env_conf):
+    xp_batch, is_weights = synthetic_batch(16, env_conf['state_shape'], env_conf['action_dim'])
+    results = []
+    for mode in ["legacy", "separate", "fused"]:
+        learner.params['fused_forward'] = mode == "fused"
+        if mode == "legacy":
+            loss, priorities = legacy_loss_and_priorities(learner, copy_batch(xp_batch), is_weights)
+        else:
+            loss, priorities = learner.compute_loss_and_priorities(copy_batch(xp_batch), is_weights)
+        results.append((loss.item(), priorities))
+    for loss, priorities in results[1:]:
+        assert np.isclose(loss, results[0][0], rtol=1e-4) and np.allclose(priorities, results[0][1], rtol=1e-4)
+    print("Learner: the losses and priorities of the legacy, separate and fused forward passes match")
+
+
+def updates_per_sec(learner, mode, xp_batch, is_weights, num_updates):
+    learner.params['fused_forward'] = mode == "fused"
+    for t in range(num_updates + 2):
+        if t == 2:  # Warm up
+            start = time.perf_counter()
+        if mode == "legacy":
+            loss, priorities = legacy_loss_and_priorities(learner, copy_batch(xp_batch), is_weights)
+        else:
+            loss, priorities = learner.compute_loss_and_priorities(copy_batch(xp_batch), is_weights)
+        learner.update_Q(loss)
+    return num_updates / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.learner_forward")
+    arg_parser.add_argument("--params-file", default="parameters.json", type=str)
+    arg_parser.add_argument("--batch-sizes", default=[32, 64, 128, 256], type=int, nargs='+',
+                            help="replay_sample_size")
+    arg_parser.add_argument("--num-threads", default=[1, 2, 4], type=int, nargs='+', help="torch intra-op threads")
+    arg_parser.add_argument("--num-updates", default=20, type=int, help="Number of updates timed per configuration")
+    args = arg_parser.parse_args()
+    params = json.load(open(args.params_file, 'r'))
+    env_conf = params["env_conf"]
+    learner = Learner(env_conf, dict(params["Learner"], load_saved_state=False), dict(), None)
+    torch.manual_seed(0)
+
+    check(learner, env_conf)
+    print("{:>8} {:>11} {:>10} {:>12} {:>14}".format("threads", "batch_size", "mode", "updates/sec", "samples/sec"))
+    for num_threads in args.num_threads:
+        torch.set_num_threads(num_threads)
+        for batch_size in args.batch_sizes:
+            xp_batch, is_weights = synthetic_batch(batch_size, env_conf['state_shape'], env_conf['action_dim'])
+            for mode in ["legacy", "separate", "fused"]:
+                rate = updates_per_sec(learner, mode, xp_batch, is_weights, args.num_updates)
+                print("{:>8} {:>11} {:>10} {:>12.2f} {:>14.1f}".format(num_threads, batch_size, mode, rate,
+                                                                       rate * batch_size))
+    learner.shared_params.unlink()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Checks and benchmarks the policy networks of the Actors.
+Publishes the parameters of a Q network (randomly initialized or loaded from a saved Learner state) as the Learner does
+and loads them into the fp32, TorchScript-traced and int8 dynamically quantized policy networks. Compares their
+Q-values and greedy actions with the fp32 network on preprocessed observations of the SyntheticEnv, before and after a
+parameter sync, which checks that the traced modules pick up the new parameters. It also checks that the dueling
+aggregation is per observation, so that the fp32 Q-values of an observation do not depend on the rest of the batch.
+The int8 ones do, within the quantization error, as the dynamic quantization scales the activations of the whole batch.
+Then it measures the time of the sync cycles of an Actor, a parameter sync followed by Q_network_sync_freq evaluations
+of single observations, which includes quantizing the weights again in the "quantized" mode. The forward latency for
+batch sizes 1 to 64, without syncs, is reported last.
+Run from the root of the repository using:
+`python -m benchmarks.policy_network`
+"""
+import json
+import time
+import numpy as np
+import torch
+from argparse import ArgumentParser
+from duelling_network import DuellingDQN
+from env import SyntheticEnv
+from param_sync import SharedParameters
+from preprocessing import ObservationPreprocessor
+from policy_network import PolicyNetwork, POLICY_NETWORKS
+
+
+def observations(state_shape, num_obs, num_actions):
+    env = SyntheticEnv(num_actions=num_actions)
+    obs_preproc = ObservationPreprocessor(state_shape)
+    obs = [obs_preproc.reset(env.reset()).copy()]
+    while len(obs) < num_obs:
+        frame, _, done, _ = env.step(np.random.randint(num_actions))
+        obs.append((obs_preproc.reset(env.reset()) if done else obs_preproc(frame)).copy())
+    return torch.from_numpy(np.stack(obs)).float()
+
+
+def check(policy_network, obs):
+    q = policy_network(obs)
+    if policy_network.mode != "quantized":
+        single = np.concatenate([policy_network(obs[i: i + 1]) for i in range(len(obs))])
+        assert np.allclose(q, single, atol=1e-4), "The Q-values of an observation depend on the rest of the batch"
+    with torch.inference_mode():
+        fp32_q = policy_network.Q(obs)[2].numpy()
+    if policy_network.mode == "traced":
+        assert np.allclose(q, fp32_q, atol=1e-4), "The traced Q-values differ from the fp32 ones"
+    return (q.argmax(1) == fp32_q.argmax(1)).mean(), np.abs(q - fp32_q).max(), np.abs(fp32_q).max()
+
+
+def train_step(Q, scale=0.01):
+    # Stands in for a few Learner updates
+    with torch.no_grad():
+        for param in Q.parameters():
+            param.add_(scale * param.abs().mean() * torch.randn_like(param))
+
+
+def sync_cycle(policy_network, shared_params, version, obs, num_steps):
+    start = time.perf_counter()
+    version = policy_network.load(shared_params, version)
+    for i in range(num_steps):
+        policy_network(obs[i % len(obs): i % len(obs) + 1])
+    return version, time.perf_counter() - start
+
+
+def latency(policy_network, obs, num_calls):
+    # TorchScript profiles and optimizes the graph for a new input shape over the first few calls
+    for _ in range(3):
+        policy_network(obs)
+    start = time.perf_counter()
+    for _ in range(num_calls):
+        policy_network(obs)
+    return (time.perf_counter() - start) / num_calls
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.policy_network")
+    arg_parser.add_argument("--params-file", default="parameters.json", type=str)
+    arg_parser.add_argument("--load-saved-state", default=None, type=str,
+                            help="Saved Learner state (see Learner.save_state) to take the Q network parameters from")
+    arg_parser.add_argument("--batch-sizes", default=[1, 2, 4, 8, 16, 32, 64], type=int, nargs='+')
+    arg_parser.add_argument("--num-obs", default=1000, type=int, help="Number of observations of the accuracy check")
+    arg_parser.add_argument("--num-cycles", default=5, type=int, help="Number of sync cycles timed per mode")
+    arg_parser.add_argument("--num-calls", default=50, type=int, help="Number of forward passes timed per batch size")
+    arg_parser.add_argument("--num-threads", default=1, type=int, help="torch intra-op threads, as on an Actor")
+    args = arg_parser.parse_args()
+    params = json.load(open(args.params_file, 'r'))
+    env_conf = params["env_conf"]
+    state_shape = tuple(env_conf["state_shape"])
+    num_steps = params["Actor"]["Q_network_sync_freq"]
+    torch.manual_seed(0)
+    torch.set_num_threads(args.num_threads)
+    obs = observations(state_shape, args.num_obs, env_conf["action_dim"])
+
+    learner_Q = DuellingDQN(state_shape, env_conf["action_dim"])
+    if args.load_saved_state:
+        learner_Q.load_state_dict(torch.load(args.load_saved_state)['Q_state'])
+    shared_params = SharedParameters(learner_Q)
+    shared_params.publish(learner_Q)
+    policy_networks = {mode: PolicyNetwork(state_shape, env_conf["action_dim"], mode, 0.0) for mode in POLICY_NETWORKS}
+    versions = {mode: policy_network.load(shared_params) for mode, policy_network in policy_networks.items()}
+
+    print("{:>10} {:>16} {:>18} {:>14} {:>14}".format("mode", "first build (s)", "action agreement", "max |dQ|",
+                                                      "max |Q|"))
+    for mode, policy_network in policy_networks.items():
+        start = time.perf_counter()
+        policy_network(obs[:1])  # Traces (and quantizes) the network
+        build_time = time.perf_counter() - start
+        print("{:>10} {:>16.3f} {:>18.4f} {:>14.6f} {:>14.4f}".format(mode, build_time, *check(policy_network, obs)))
+    train_step(learner_Q)
+    shared_params.publish(learner_Q)
+    print("After a parameter sync:")
+    for mode, policy_network in policy_networks.items():
+        versions[mode] = policy_network.load(shared_params, versions[mode])
+        print("{:>10} {:>16} {:>18.4f} {:>14.6f} {:>14.4f}".format(mode, "", *check(policy_network, obs)))
+
+    cycle_times = {mode: [] for mode in POLICY_NETWORKS}
+    for _ in range(args.num_cycles):
+        train_step(learner_Q)
+        shared_params.publish(learner_Q)
+        for mode, policy_network in policy_networks.items():
+            versions[mode], cycle_time = sync_cycle(policy_network, shared_params, versions[mode], obs, num_steps)
+            cycle_times[mode].append(cycle_time)
+    print("\nSync cycle: a parameter sync and {} evaluations of single observations".format(num_steps))
+    print("{:>10} {:>14} {:>14} {:>14}".format("mode", "cycle (s)", "steps/s", "speed-up"))
+    for mode in POLICY_NETWORKS:
+        cycle_time = np.median(cycle_times[mode])
+        print("{:>10} {:>14.3f} {:>14.1f} {:>14.2f}".format(mode, cycle_time, num_steps / cycle_time,
+                                                             np.median(cycle_times["eager"]) / cycle_time))
+    shared_params.unlink()
+
+    print("\nForward latency without syncs")
+    print("{:>10} ".format("batch") + " ".join("{:>14}".format(mode + " (ms)") for mode in POLICY_NETWORKS))
+    for batch_size in args.batch_sizes:
+        print("{:>10} ".format(batch_size) + " ".join(
+            "{:>14.3f}".format(1e3 * latency(policy_network, obs[:batch_size], args.num_calls))
+            for policy_network in policy_networks.values()))
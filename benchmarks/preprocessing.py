@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+Per-frame timing of the Actor's observation preprocessing.
+Compares the cv2 based ObservationPreprocessor with the float64 np.dot/np.resize preprocessing that it replaced and
+times the max-pooling of MaxPoolFrameSkip.
+Run from the root of the repository using:
+`python -m benchmarks.preprocessing`
+"""
+import time
+import numpy as np
+from argparse import ArgumentParser
+from preprocessing import MaxPoolFrameSkip, ObservationPreprocessor
+
+RAW_FRAME_SHAPE = (210, 160, 3)
+
+
+def legacy_obs_preproc(state_shape):
+    """
+    The preprocessing that the ObservationPreprocessor replaced. Kept here only as a baseline
+    """
+    rgb2gray = lambda x: np.dot(x, np.array([[0.299, 0.587, 0.114]]).T)
+    torch_shape = lambda x: np.reshape(rgb2gray(x), (1, x.shape[1], x.shape[0]))
+    return lambda x: np.resize(torch_shape(x), state_shape)
+
+
+class RandomFrameEnv(object):
+    def __init__(self, frames):
+        self.frames = frames
+        self.t = 0
+
+    def reset(self):
+        return self.frames[0]
+
+    def step(self, action):
+        self.t += 1
+        return self.frames[self.t % len(self.frames)], 0.0, False, {}
+
+
+def time_per_frame(preproc, frames):
+    start = time.perf_counter()
+    for frame in frames:
+        obs = preproc(frame)
+    return (time.perf_counter() - start) / len(frames), obs.nbytes
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.preprocessing")
+    arg_parser.add_argument("--num-frames", default=2000, type=int)
+    arg_parser.add_argument("--num-stacked-frames", default=[1, 4], type=int, nargs='+',
+                            help="state_shape[0]")
+    arg_parser.add_argument("--frame-skip", default=4, type=int)
+    args = arg_parser.parse_args()
+    frames = [np.random.randint(0, 255, RAW_FRAME_SHAPE, dtype=np.uint8) for _ in range(64)]
+    frames = [frames[i % len(frames)] for i in range(args.num_frames)]
+
+    print("{:>8} {:>10} {:>14} {:>12}".format("stack", "pipeline", "us/frame", "obs bytes"))
+    for k in args.num_stacked_frames:
+        state_shape = (k, 84, 84)
+        for name, preproc in [("legacy", legacy_obs_preproc(state_shape)),
+                              ("cv2", ObservationPreprocessor(state_shape))]:
+            seconds, nbytes = time_per_frame(preproc, frames)
+            print("{:>8} {:>10} {:>14.2f} {:>12}".format(k, name, 1e6 * seconds, nbytes))
+
+    env = MaxPoolFrameSkip(RandomFrameEnv(frames), args.frame_skip)
+    start = time.perf_counter()
+    for _ in range(args.num_frames // args.frame_skip):
+        env.step(0)
+    print("MaxPoolFrameSkip({}): {:.2f} us/action excluding the environment".format(
+        args.frame_skip, 1e6 * (time.perf_counter() - start) / (args.num_frames // args.frame_skip)))
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the prioritized sampling engine of the ReplayMemory.
+Compares the sum-tree backed ReplayMemory with the dictionary based sampling path that it replaced. The priority update
+of the dict path is quadratic in the number of entries and takes hours at 1M entries. It is only timed up to
+--dict-max-entries entries and its times at the larger sizes are extrapolated from the scaling measured at 1/4, 1/2 and
+all of --dict-max-entries entries. They are printed as "dict est.".
+Run from the root of the repository using:
+`python -m benchmarks.replay_sampling`
+"""
+import time
+import numpy as np
+from argparse import ArgumentParser
+from replay import ReplayMemory, N_Step_Transition
+
+
+class DictReplayMemory(object):
+    """
+    The dictionary based prioritized sampling path that the sum-tree replaced. Kept here only as a baseline
+    """
+    def __init__(self, params):
+        self.memory = list()
+        self.alpha = params['priority_exponent']
+        self.priorities = dict()
+        self.sample_probabilities = dict()
+
+    def update_sample_probabilities(self):
+        priorities = self.priorities
+        prob = [p**self.alpha/ sum(priorities.values())  for p in priorities.values()]
+        prob /= sum(prob)
+        self.sample_probabilities.update({k:v for k in list(priorities) for v in prob})
+        sum_of_prob = sum(self.sample_probabilities.values())
+        for k in self.sample_probabilities.keys():
+            self.sample_probabilities[k] /= sum_of_prob
+
+    def set_priorities(self, new_priorities):
+        self.priorities.update(new_priorities)
+        self.update_sample_probabilities()
+
+    def sample(self, sample_size):
+        mem = N_Step_Transition(*zip(*self.memory))
+        sampled_keys = [np.random.choice(list(self.priorities.keys()), p=list(self.sample_probabilities.values()))
+                        for _ in range(sample_size) ]
+        batch_xp = [N_Step_Transition(S, A, R, G, qt, Sn, qn, key) for k in sampled_keys
+                    for S, A, R, G, qt, Sn, qn, key in zip(mem.S_t, mem.A_t, mem.R_ttpB, mem.Gamma_ttpB,
+                                                           mem.qS_t, mem.S_tpn, mem.qS_tpn, mem.key) if key == k]
+        return batch_xp
+
+
+def dummy_transitions(start, num):
+    # Tiny frames are used so that the benchmark measures the sampling engine and not the memory footprint
+    frame, q = np.zeros((1, 1, 1)), np.zeros(4)
+    return [N_Step_Transition(k, 0, 0.0, 0.99, q, k + 1, q, k) for k in range(start, start + num)], \
+           {k: frame for k in range(start, start + num + 1)}
+
+
+def time_per_call(fn, max_calls, max_seconds):
+    num_calls = 0
+    start = time.perf_counter()
+    while num_calls < max_calls and time.perf_counter() - start < max_seconds:
+        fn()
+        num_calls += 1
+    return (time.perf_counter() - start) / num_calls
+
+
+def benchmark(num_entries, batch_size, params, max_calls, max_seconds):
+    keys = np.arange(num_entries)
+
+    replay_mem = ReplayMemory(num_entries, params)
+    fill_size = 10000
+    for start in range(0, num_entries, fill_size):
+        xp_batch, frames = dummy_transitions(start, min(fill_size, num_entries - start))
+        replay_mem.add(np.random.uniform(size=len(xp_batch)), xp_batch, frames)
+
+    def sum_tree_update():
+        # The experience with key k is in slot k
+        slots = np.random.choice(keys, batch_size)
+        replay_mem.set_priorities(slots, slots, np.random.uniform(size=batch_size))
+    return (time_per_call(lambda: replay_mem.sample(batch_size), max_calls, max_seconds),
+            time_per_call(sum_tree_update, max_calls, max_seconds))
+
+
+def dict_benchmark(num_entries, batch_size, params, max_calls, max_seconds):
+    keys = np.arange(num_entries)
+    dict_mem = DictReplayMemory(params)
+    dict_mem.memory, _ = dummy_transitions(0, num_entries)
+    dict_mem.priorities = dict(zip(keys, np.random.uniform(size=num_entries)))
+    dict_mem.update_sample_probabilities()
+
+    def dict_update():
+        dict_mem.set_priorities({k: p for k, p in zip(np.random.choice(keys, batch_size),
+                                                      np.random.uniform(size=batch_size))})
+    return (time_per_call(lambda: dict_mem.sample(batch_size), max_calls, max_seconds),
+            time_per_call(dict_update, max_calls, max_seconds))
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.replay_sampling")
+    arg_parser.add_argument("--sizes", default=[10000, 100000, 1000000], type=int, nargs='+',
+                            help="Number of entries in the replay memory")
+    arg_parser.add_argument("--batch-size", default=32, type=int)
+    arg_parser.add_argument("--max-seconds", default=5.0, type=float,
+                            help="Time budget per measurement. The dict path gets at least one call per measurement")
+    arg_parser.add_argument("--dict-max-entries", default=10000, type=int,
+                            help="Largest memory size at which the dict path is timed. Its times at the larger sizes "
+                                 "are extrapolated")
+    args = arg_parser.parse_args()
+    params = {"priority_exponent": 0.6, "importance_sampling_exponent": 0.4, "frame_compression": None}
+
+    # Scaling of the dict path, fitted in log-log space
+    fit_sizes = [args.dict_max_entries // 4, args.dict_max_entries // 2, args.dict_max_entries]
+    dict_times = {num_entries: dict_benchmark(num_entries, args.batch_size, params, 1000, args.max_seconds)
+                  for num_entries in fit_sizes}
+    exponents = np.polyfit(np.log(fit_sizes), np.log([dict_times[num_entries] for num_entries in fit_sizes]), 1)[0]
+
+    print("{:>10} {:>10} {:>14} {:>14}".format("entries", "engine", "sample (ms)", "update (ms)"))
+    for num_entries in args.sizes:
+        results = [("sum_tree", benchmark(num_entries, args.batch_size, params, 1000, args.max_seconds))]
+        if num_entries > args.dict_max_entries:
+            scale = (num_entries / args.dict_max_entries) ** exponents
+            results.append(("dict est.", np.array(dict_times[args.dict_max_entries]) * scale))
+        elif num_entries in dict_times:
+            results.append(("dict", dict_times[num_entries]))
+        else:
+            results.append(("dict", dict_benchmark(num_entries, args.batch_size, params, 1000, args.max_seconds)))
+        for engine, (sample_time, update_time) in results:
+            print("{:>10} {:>10} {:>14.3f} {:>14.3f}".format(num_entries, engine, sample_time * 1e3,
+                                                            update_time * 1e3))
+    print("dict est.: extrapolated from the dict path's scaling up to {} entries, sample ~ N^{:.2f} and update ~ "
+          "N^{:.2f}".format(args.dict_max_entries, *exponents))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark of the sharded replay memory.
+Measures the aggregate insert throughput of a fixed number of Actors sending synthetic experience through the shared
+memory transport and the aggregate sample (+ priority update) throughput of a fixed number of Learner-side sampling
+processes, for different numbers of replay memory shards.
+Run from the root of the repository using:
+`python -m benchmarks.replay_sharding`
+"""
+import time
+import numpy as np
+import torch.multiprocessing as mp
+from argparse import ArgumentParser
+from multiprocessing.managers import BaseManager
+from replay import ReplayMemory, ShardedReplayMemory, shard_of_actor
+from transport import SharedFrameRing
+from benchmarks.replay_transport import FRAME_SHAPE, shared_memory_producer, wait_for
+
+BaseManager.register("Memory", ReplayMemory)
+PARAMS = {"priority_exponent": 0.6, "importance_sampling_exponent": 0.4, "frame_compression": None}
+
+
+def sampler(replay_mem, batch_size, seconds, num_samples):
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        xp_batch, slots, _ = replay_mem.sample(batch_size)
+        replay_mem.set_priorities(slots, xp_batch.key, np.random.uniform(size=len(slots)))
+        with num_samples.get_lock():
+            num_samples.value += len(slots)
+
+
+def benchmark(num_shards, num_actors, num_batches, batch_size, num_samplers, sample_size, seconds):
+    """
+    :return: Inserted transitions per second and sampled transitions per second across all the shards
+    """
+    num_transitions = num_actors * num_batches * batch_size
+    mp_manager = mp.Manager()
+    shared_mems = [mp_manager.Queue() for _ in range(num_shards)]
+    replay_managers = [BaseManager() for _ in range(num_shards)]
+    [replay_manager.start() for replay_manager in replay_managers]
+    replay_mem = ShardedReplayMemory([replay_manager.Memory(num_transitions, PARAMS)
+                                      for replay_manager in replay_managers], PARAMS)
+    replay_mem.start_ingest(shared_mems)
+
+    rings = [SharedFrameRing(FRAME_SHAPE, 2048) for _ in range(num_actors)]
+    procs = [mp.Process(target=shared_memory_producer,
+                        args=(i, shared_mems[shard_of_actor(i, num_shards)], rings[i].spec, num_batches, batch_size))
+             for i in range(num_actors)]
+    start_time = time.perf_counter()
+    [proc.start() for proc in procs]
+    wait_for(replay_mem, num_transitions)
+    insert_throughput = num_transitions / (time.perf_counter() - start_time)
+    [proc.join() for proc in procs]
+
+    num_samples = mp.Value('l', 0)
+    procs = [mp.Process(target=sampler, args=(replay_mem, sample_size, seconds, num_samples))
+             for _ in range(num_samplers)]
+    start_time = time.perf_counter()
+    [proc.start() for proc in procs]
+    [proc.join() for proc in procs]
+    sample_throughput = num_samples.value / (time.perf_counter() - start_time)
+
+    for ring in rings:
+        ring.close()
+        ring.unlink()
+    [replay_manager.shutdown() for replay_manager in replay_managers]
+    mp_manager.shutdown()
+    return insert_throughput, sample_throughput
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.replay_sharding")
+    arg_parser.add_argument("--num-shards", default=[1, 2, 4], type=int, nargs='+')
+    arg_parser.add_argument("--num-actors", default=8, type=int)
+    arg_parser.add_argument("--num-batches", default=500, type=int, help="Number of batches sent by each actor")
+    arg_parser.add_argument("--batch-size", default=5, type=int, help="n_step_transition_batch_size")
+    arg_parser.add_argument("--num-samplers", default=4, type=int, help="Number of sampling processes")
+    arg_parser.add_argument("--sample-size", default=32, type=int, help="replay_sample_size")
+    arg_parser.add_argument("--seconds", default=5.0, type=float, help="Duration of the sampling benchmark")
+    args = arg_parser.parse_args()
+
+    print("{:>8} {:>24} {:>24}".format("shards", "inserts (transitions/s)", "samples (transitions/s)"))
+    for num_shards in args.num_shards:
+        inserts, samples = benchmark(num_shards, args.num_actors, args.num_batches, args.batch_size,
+                                     args.num_samplers, args.sample_size, args.seconds)
+        print("{:>8} {:>24.1f} {:>24.1f}".format(num_shards, inserts, samples))
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Benchmark of the replay memory snapshots.
+Fills a ReplayMemory with synthetic experience, measures the sample latency while a snapshot is written in the
+background, the size and write time of the snapshot and the time until a restored replay memory can be sampled from
+with the lazy and the full restore. The restored experiences, priorities and frames are checked against the original.
+Run from the root of the repository using:
+`python -m benchmarks.replay_snapshot`
+"""
+import os
+import time
+import shutil
+import tempfile
+import numpy as np
+from argparse import ArgumentParser
+from replay import ReplayMemory, N_Step_Transition, pack_key
+
+FRAME_SHAPE = (1, 84, 84)
+PARAMS = {"priority_exponent": 0.6, "importance_sampling_exponent": 0.4, "frame_compression": None}
+
+
+def synthetic_frame():
+    # Like the preprocessed Atari frames, the synthetic frames are made of flat regions
+    blocks = np.random.randint(0, 255, (1, 12, 12), dtype=np.uint8)
+    return np.kron(blocks, np.ones((1, 7, 7), dtype=np.uint8))
+
+
+def fill(replay_mem, num_transitions, batch_size=100, priorities=np.random.uniform, num_distinct_frames=None):
+    """
+    Adds num_transitions synthetic experiences to replay_mem
+    :param priorities: Function that draws the priorities of a batch given its size
+    :param num_distinct_frames: Number of synthetic frames cycled through. A new frame is made for every key if None
+    """
+    distinct_frames = [synthetic_frame() for _ in range(num_distinct_frames or 0)]
+    q = np.zeros(4, dtype=np.float32)
+    for start in range(0, num_transitions, batch_size):
+        xp_batch = [N_Step_Transition(pack_key(0, k), 0, 1.0, 0.99, q, pack_key(0, k + 1), q, pack_key(0, k))
+                    for k in range(start, start + batch_size)]
+        frames = {pack_key(0, k): distinct_frames[k % num_distinct_frames] if distinct_frames else synthetic_frame()
+                  for k in range(start, start + batch_size + 1)}
+        replay_mem.add(priorities(size=batch_size), xp_batch, frames)
+
+
+def sample_latencies(replay_mem, batch_size, seconds, until=None):
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline and (until is None or until()):
+        start = time.perf_counter()
+        replay_mem.sample(batch_size)
+        latencies.append(time.perf_counter() - start)
+    return 1e3 * np.percentile(latencies, 50), 1e3 * np.percentile(latencies, 99)
+
+
+def check(original, restored):
+    used = np.flatnonzero(original.memory.key != -1)
+    assert np.all(restored.memory.key[used] < -1)
+    for field in ['A_t', 'R_ttpB', 'Gamma_ttpB', 'qS_t', 'qS_tpn']:
+        assert np.array_equal(getattr(original.memory, field)[used], getattr(restored.memory, field)[used])
+    assert np.allclose(original.priority_sum[used], restored.priority_sum[used])
+    assert np.isclose(original.priority_sum.total(), restored.priority_sum.total())
+    for field in ['S_t', 'S_tpn']:
+        assert np.array_equal(original.frame_pool.get(getattr(original.memory, field)[used]),
+                              restored.frame_pool.get(getattr(restored.memory, field)[used]))
+    assert original.counter == restored.counter
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.replay_snapshot")
+    arg_parser.add_argument("--num-transitions", default=100000, type=int)
+    arg_parser.add_argument("--batch-size", default=32, type=int, help="replay_sample_size")
+    arg_parser.add_argument("--dir", default=None, type=str, help="Directory to write the snapshot to")
+    args = arg_parser.parse_args()
+    snapshot_dir = args.dir or tempfile.mkdtemp()
+    path = os.path.join(snapshot_dir, "replay_snapshot")
+
+    replay_mem = ReplayMemory(args.num_transitions, PARAMS)
+    fill(replay_mem, args.num_transitions)
+    print("sample latency (idle): p50 {:.3f} ms, p99 {:.3f} ms".format(
+        *sample_latencies(replay_mem, args.batch_size, 2.0)))
+
+    start = time.perf_counter()
+    replay_mem.save_snapshot(path)
+    p50, p99 = sample_latencies(replay_mem, args.batch_size, 600.0, until=replay_mem.snapshot_thread.is_alive)
+    replay_mem.snapshot_thread.join()
+    size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    print("snapshot: {:.2f} s, {:.1f} MB ({:.1f} MB of raw frames)".format(
+        time.perf_counter() - start, size / 2 ** 20, replay_mem.frame_pool.size() * np.prod(FRAME_SHAPE) / 2 ** 20))
+    print("sample latency (while writing the snapshot): p50 {:.3f} ms, p99 {:.3f} ms".format(p50, p99))
+
+    for lazy in [True, False]:
+        restored = ReplayMemory(args.num_transitions, PARAMS)
+        start = time.perf_counter()
+        restored.restore_snapshot(path, lazy=lazy)
+        restored.sample(args.batch_size)
+        first_sample = time.perf_counter() - start
+        while restored.frame_pool.snapshot is not None:
+            time.sleep(0.001)
+        print("restore (lazy={}): first sample after {:.3f} s, all frames loaded after {:.3f} s".format(
+            lazy, first_sample, time.perf_counter() - start))
+        check(replay_mem, restored)
+    print("Restored replay memory matches the original")
+    if args.dir is None:
+        shutil.rmtree(snapshot_dir)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Throughput benchmark of the transport that moves n-step transitions from the Actors into the replay memory.
+Compares the shared memory frame rings with the previous path where every batch of transitions, including its frames,
+was pickled through a Manager queue and forwarded to the replay memory through a BaseManager proxy.
+Run from the root of the repository using:
+`python -m benchmarks.replay_transport`
+"""
+import time
+import numpy as np
+import torch.multiprocessing as mp
+from argparse import ArgumentParser
+from multiprocessing.managers import BaseManager
+from replay import ReplayMemory, N_Step_Transition, pack_key
+from transport import SharedFrameRing
+
+BaseManager.register("Memory", ReplayMemory)
+FRAME_SHAPE = (1, 84, 84)
+
+
+def synthetic_batches(actor_id, num_batches, batch_size):
+    """
+    Generates batches of n-step transitions that share their S_tpn and S_t frames like the ones sent by an Actor
+    """
+    frame = np.random.randint(0, 255, FRAME_SHAPE, dtype=np.uint8)
+    q = np.zeros(4, dtype=np.float32)
+    frame_seq_num = 0
+    for b in range(num_batches):
+        xp_batch, frames = [], dict()
+        for i in range(batch_size):
+            seq_num = b * batch_size + i
+            S_t, S_tpn = pack_key(actor_id, frame_seq_num), pack_key(actor_id, frame_seq_num + 1)
+            if b == 0 and i == 0:
+                frames[S_t] = frame
+            frames[S_tpn] = frame
+            frame_seq_num += 1
+            xp_batch.append(N_Step_Transition(S_t, 0, 0.0, 0.99, q, S_tpn, q, pack_key(actor_id, seq_num)))
+        yield np.ones(batch_size, dtype=np.float32), xp_batch, frames
+
+
+def manager_producer(actor_id, shared_mem, num_batches, batch_size):
+    for priorities, xp_batch, frames in synthetic_batches(actor_id, num_batches, batch_size):
+        shared_mem.put([priorities, xp_batch, frames])
+
+
+def manager_forwarder(shared_mem, replay_mem):
+    while True:
+        priorities, xp_batch, frames = shared_mem.get()
+        replay_mem.add(priorities, xp_batch, frames)
+
+
+def shared_memory_producer(actor_id, shared_mem, ring_spec, num_batches, batch_size):
+    ring = SharedFrameRing(ring_spec[1], ring_spec[2], name=ring_spec[0])
+    for priorities, xp_batch, frames in synthetic_batches(actor_id, num_batches, batch_size):
+        start = ring.put(list(frames.values()))
+        shared_mem.put([priorities, xp_batch, list(frames.keys()), ring.spec, start])
+    ring.close()
+
+
+def wait_for(replay_mem, num_transitions):
+    while replay_mem.size() < num_transitions:
+        time.sleep(0.01)
+
+
+def benchmark(transport, num_actors, num_batches, batch_size, ring_capacity):
+    num_transitions = num_actors * num_batches * batch_size
+    mp_manager = mp.Manager()
+    shared_mem = mp_manager.Queue()
+    replay_manager = BaseManager()
+    replay_manager.start()
+    replay_mem = replay_manager.Memory(num_transitions, {"priority_exponent": 0.6,
+                                                         "importance_sampling_exponent": 0.4,
+                                                         "frame_compression": None})
+    rings, procs = [], []
+    start_time = time.perf_counter()
+    if transport == "manager":
+        procs.append(mp.Process(target=manager_forwarder, args=(shared_mem, replay_mem), daemon=True))
+        for i in range(num_actors):
+            procs.append(mp.Process(target=manager_producer, args=(i, shared_mem, num_batches, batch_size)))
+    else:
+        replay_mem.start_ingest(shared_mem)
+        for i in range(num_actors):
+            rings.append(SharedFrameRing(FRAME_SHAPE, ring_capacity))
+            procs.append(mp.Process(target=shared_memory_producer,
+                                    args=(i, shared_mem, rings[-1].spec, num_batches, batch_size)))
+    [proc.start() for proc in procs]
+    wait_for(replay_mem, num_transitions)
+    elapsed = time.perf_counter() - start_time
+    [proc.terminate() for proc in procs]
+    for ring in rings:
+        ring.close()
+        ring.unlink()
+    replay_manager.shutdown()
+    mp_manager.shutdown()
+    return num_transitions / elapsed
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.replay_transport")
+    arg_parser.add_argument("--num-actors", default=[1, 2, 4], type=int, nargs='+')
+    arg_parser.add_argument("--num-batches", default=500, type=int, help="Number of batches sent by each actor")
+    arg_parser.add_argument("--batch-size", default=5, type=int, help="n_step_transition_batch_size")
+    arg_parser.add_argument("--ring-capacity", default=2048, type=int, help="shared_frame_ring_capacity")
+    args = arg_parser.parse_args()
+
+    print("{:>10} {:>14} {:>18}".format("actors", "transport", "transitions/sec"))
+    for num_actors in args.num_actors:
+        for transport in ["manager", "shared_memory"]:
+            throughput = benchmark(transport, num_actors, args.num_batches, args.batch_size, args.ring_capacity)
+            print("{:>10} {:>14} {:>18.1f}".format(num_actors, transport, throughput))
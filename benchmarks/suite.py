@@ -0,0 +1,255 @@
+"""
+End-to-end benchmark suite of the Actors, ExperienceBuffer, ReplayMemory and Learner, individually and as the whole
+Ape-X pipeline of main.py, on the deterministic SyntheticEnv (see env.py) instead of the Atari environments.
+Every benchmark runs in a fresh process and returns a dictionary of measurements along with the peak resident memory of
+its process tree. The frames/sec count the observations processed by the Actors. Every observation is frame_skip
+emulator frames. The command line entry point is benchmarks/__main__.py
+"""
+import os
+import time
+import random
+import threading
+import traceback
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from multiprocessing.managers import BaseManager
+from actor import Actor, ExperienceBuffer, Transition
+from duelling_network import DuellingDQN
+from learner import Learner
+from metrics import SharedMetrics, COUNTER_INDEX
+from param_sync import SharedParameters
+from replay import ReplayMemory, ShardedReplayMemory, shard_of_actor
+from benchmarks.replay_snapshot import synthetic_frame, fill
+
+BaseManager.register("Memory", ReplayMemory)
+COMPONENTS = ("experience_buffer", "actor", "replay", "learner", "end_to_end")
+
+
+def resident_memory(pid):
+    try:
+        with open("/proc/{}/status".format(pid)) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:  # The process has exited
+        pass
+    return 0
+
+
+class PeakMemory(threading.Thread):
+    def __init__(self, interval=0.05):
+        """
+        Samples the total resident memory of the process and all its child processes (Actors, Learner, replay memory
+        shards, ...) every interval seconds and keeps the maximum. Shared memory is counted in every process mapping it
+        """
+        super(PeakMemory, self).__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self.stop_event = threading.Event()
+
+    def run(self):
+        while not self.stop_event.is_set():
+            pids = [os.getpid()] + [child.pid for child in mp.active_children()]
+            self.peak = max(self.peak, sum(resident_memory(pid) for pid in pids))
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
+        return self.peak
+
+
+def _isolated(benchmark, args, results):
+    random.seed(0)
+    np.random.seed(0)
+    torch.manual_seed(0)
+    peak_memory = PeakMemory()
+    peak_memory.start()
+    try:
+        start = time.perf_counter()
+        measurements = benchmark(*args)
+        measurements["seconds"] = time.perf_counter() - start
+        measurements["peak_rss_mb"] = peak_memory.stop() / 2 ** 20
+        results.put(measurements)
+    except Exception:
+        results.put({"error": traceback.format_exc()})
+
+
+def run_isolated(benchmark, *args):
+    """
+    Runs benchmark(*args) in a fresh process so that the measurements, in particular the peak memory, of the
+    benchmarks do not depend on each other
+    :return: The measurements returned by the benchmark with its duration (seconds) and peak_rss_mb
+    """
+    results = mp.Queue()
+    proc = mp.Process(target=_isolated, args=(benchmark, args, results))
+    proc.start()
+    measurements = results.get()
+    proc.join()
+    if "error" in measurements:
+        raise RuntimeError("{} failed:\n{}".format(benchmark.__name__, measurements["error"]))
+    return measurements
+
+
+def _configure(params, env_name, num_actors=None, capacity=None, batch_size=None):
+    """
+    :return: Copies of the env_conf, Actor, Learner and Replay_Memory sections of params with the SyntheticEnv and the
+    benchmarked configuration
+    """
+    env_conf = dict(params["env_conf"], name=env_name)
+    actor_params = dict(params["Actor"])
+    learner_params = dict(params["Learner"], checkpoint_freq=0, load_saved_state=False)
+    replay_params = dict(params["Replay_Memory"])
+    if num_actors is not None:
+        actor_params["num_actors"] = num_actors
+    if capacity is not None:
+        replay_params["soft_capacity"] = capacity
+    if batch_size is not None:
+        learner_params["replay_sample_size"] = batch_size
+    return env_conf, actor_params, learner_params, replay_params
+
+
+def experience_buffer(params, env_name, num_steps):
+    """
+    :return: frames_per_sec stored in an ExperienceBuffer and batched into n-step transitions
+    """
+    env_conf, actor_params, _, _ = _configure(params, env_name)
+    buffer = ExperienceBuffer(actor_params["num_steps"], 0, actor_params["gamma"])
+    frames = [synthetic_frame().reshape(env_conf["state_shape"]) for _ in range(64)]
+    q = np.zeros(env_conf["action_dim"], dtype=np.float32)
+    start = time.perf_counter()
+    obs_key = buffer.store_frame(frames[0])
+    for t in range(num_steps):
+        buffer.add(Transition(obs_key, 0, 1.0, actor_params["gamma"], q))
+        obs_key = buffer.store_frame(frames[t % len(frames)])
+        if t % 250 == 249:  # End of an episode
+            buffer.flush(Transition(obs_key, 0, 0.0, actor_params["gamma"], q))
+            obs_key = buffer.store_frame(frames[0])
+        while buffer.size >= actor_params["n_step_transition_batch_size"]:
+            buffer.get(actor_params["n_step_transition_batch_size"])
+    return {"frames_per_sec": num_steps / (time.perf_counter() - start)}
+
+
+def actor(params, env_name, num_actors, num_steps):
+    """
+    Runs num_actors Actors for num_steps steps each, with their experience ingested by a replay memory process
+    :return: frames_per_sec across all the Actors
+    """
+    env_conf, actor_params, _, replay_params = _configure(params, env_name, num_actors=num_actors)
+    actor_params["T"] = num_steps
+    mp_manager = mp.Manager()
+    shared_state = mp_manager.dict()
+    Q = DuellingDQN(env_conf['state_shape'], env_conf['action_dim'])
+    shared_params = SharedParameters(Q)
+    shared_params.publish(Q)
+    shared_state["Q_params"] = shared_params
+    shared_mem = mp_manager.Queue()
+    replay_manager = BaseManager()
+    replay_manager.start()
+    replay_mem = replay_manager.Memory(replay_params["soft_capacity"], replay_params)
+    replay_mem.start_ingest(shared_mem)
+
+    actors = [Actor(i, env_conf, shared_state, shared_mem, actor_params) for i in range(num_actors)]
+    start = time.perf_counter()
+    [actor_proc.start() for actor_proc in actors]
+    [actor_proc.join() for actor_proc in actors]
+    elapsed = time.perf_counter() - start
+    for actor_proc in actors:
+        actor_proc.frame_ring.close()
+        actor_proc.frame_ring.unlink()
+    shared_params.unlink()
+    replay_manager.shutdown()
+    mp_manager.shutdown()
+    return {"frames_per_sec": num_actors * actor_params["num_envs_per_actor"] * num_steps / elapsed}
+
+
+def replay(params, env_name, capacity, batch_size, seconds):
+    """
+    Fills a ReplayMemory of the given capacity and then samples from it and updates the priorities of the samples
+    :return: inserts_per_sec and samples_per_sec in transitions
+    """
+    _, _, _, replay_params = _configure(params, env_name, capacity=capacity)
+    replay_mem = ReplayMemory(capacity, replay_params)
+    start = time.perf_counter()
+    fill(replay_mem, capacity)
+    inserts_per_sec = capacity / (time.perf_counter() - start)
+    num_samples = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < seconds:
+        xp_batch, slots, _ = replay_mem.sample(batch_size)
+        replay_mem.set_priorities(slots, xp_batch.key, np.random.uniform(size=len(slots)))
+        num_samples += len(slots)
+    return {"inserts_per_sec": inserts_per_sec, "samples_per_sec": num_samples / (time.perf_counter() - start)}
+
+
+def learner(params, env_name, capacity, batch_size, num_updates):
+    """
+    Runs num_updates Learner updates on batches sampled from a filled ReplayMemory of the given capacity
+    :return: updates_per_sec
+    """
+    env_conf, _, learner_params, replay_params = _configure(params, env_name, capacity=capacity, batch_size=batch_size)
+    learner_params["min_replay_mem_size"] = 0
+    replay_mem = ReplayMemory(capacity, replay_params)
+    fill(replay_mem, capacity)
+    learner_proc = Learner(env_conf, learner_params, dict(), replay_mem)
+    start = time.perf_counter()
+    learner_proc.learn(num_updates)
+    elapsed = time.perf_counter() - start
+    learner_proc.shared_params.unlink()
+    return {"updates_per_sec": num_updates / elapsed}
+
+
+def end_to_end(params, env_name, num_actors, capacity, batch_size, min_replay_mem_size, seconds):
+    """
+    Runs the Actors, the replay memory shards and the Learner like main.py. Once the Learner has started updating the
+    Q network, the throughput is measured over seconds with the metrics recorded by all the processes.
+    :return: frames_per_sec across all the Actors, transitions_per_sec inserted into the replay memory and
+    updates_per_sec of the Learner
+    """
+    env_conf, actor_params, learner_params, replay_params = _configure(params, env_name, num_actors, capacity,
+                                                                       batch_size)
+    actor_params["T"] = 2 ** 62  # The Actors and the Learner are terminated after the measurement
+    learner_params["min_replay_mem_size"] = min(min_replay_mem_size, capacity // 2)
+    num_shards = replay_params["num_shards"]
+    metrics = SharedMetrics({"actor": num_actors, "replay": num_shards, "learner": 1})
+
+    mp_manager = mp.Manager()
+    shared_state = mp_manager.dict()
+    shared_mems = [mp_manager.Queue() for _ in range(num_shards)]
+    replay_managers = [BaseManager() for _ in range(num_shards)]
+    [replay_manager.start() for replay_manager in replay_managers]
+    replay_mem = ShardedReplayMemory([replay_manager.Memory(capacity // num_shards, replay_params,
+                                                           metrics.writer("replay", i))
+                                      for i, replay_manager in enumerate(replay_managers)], replay_params)
+    learner = Learner(env_conf, learner_params, shared_state, replay_mem, metrics.writer("learner"))
+    learner_proc = mp.Process(target=learner.learn, args=(2 ** 62,))
+    learner_proc.start()
+    actors = [Actor(i, env_conf, shared_state, shared_mems[shard_of_actor(i, num_shards)], actor_params, None,
+                    metrics.writer("actor", i)) for i in range(num_actors)]
+    [actor_proc.start() for actor_proc in actors]
+    replay_mem.start_ingest(shared_mems)
+
+    learner_updates = metrics.read()[:, COUNTER_INDEX["learner_updates"]]
+    while learner_updates.sum() == 0 and learner_proc.is_alive():
+        time.sleep(0.1)
+        learner_updates = metrics.read()[:, COUNTER_INDEX["learner_updates"]]
+    previous, start = metrics.read(), time.perf_counter()
+    time.sleep(seconds)
+    summary = SharedMetrics.summarize(previous, metrics.read(), time.perf_counter() - start)
+
+    [proc.terminate() for proc in actors + [learner_proc]]
+    [proc.join() for proc in actors + [learner_proc]]
+    if learner_proc.exitcode > 0:
+        raise RuntimeError("The Learner exited with {}".format(learner_proc.exitcode))
+    for actor_proc in actors:
+        actor_proc.frame_ring.close()
+        actor_proc.frame_ring.unlink()
+    learner.shared_params.unlink()
+    [replay_manager.shutdown() for replay_manager in replay_managers]
+    mp_manager.shutdown()
+    metrics.close()
+    metrics.unlink()
+    return {"frames_per_sec": summary["counters"]["actor_frames"]["per_sec"],
+            "transitions_per_sec": summary["counters"]["replay_inserts"]["per_sec"],
+            "updates_per_sec": summary["counters"]["learner_updates"]["per_sec"]}
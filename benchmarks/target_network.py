@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+Checks and benchmarks the target network updates and parameter publishing of the Learner.
+Checks the hard sync and the Polyak soft update of the TargetNetwork, that the flattened Q network is still trained in
+place by the optimizer and that publishing from the flat buffer gives the Actors the same parameters as publishing the
+state_dict. Then measures the per-call cost of the load_state_dict(state_dict()) sync that the Learner used to run on
+almost every update, of torch._foreach ops over the per-tensor parameters and of the single ops over the flat buffer,
+and of publishing the parameters to shared memory.
+Run from the root of the repository using:
+`python -m benchmarks.target_network`
+"""
+import time
+import torch
+from argparse import ArgumentParser
+from duelling_network import DuellingDQN
+from param_sync import SharedParameters
+from target_network import TargetNetwork
+
+STATE_SHAPE = (1, 84, 84)
+ACTION_DIM = 4
+
+
+def time_per_call(fn, num_calls):
+    fn()
+    start = time.perf_counter()
+    for _ in range(num_calls):
+        fn()
+    return (time.perf_counter() - start) / num_calls
+
+
+def train_step(Q, optimizer):
+    optimizer.zero_grad()
+    Q(torch.rand((8,) + STATE_SHAPE))[2].sum().backward()
+    optimizer.step()
+
+
+def check(tau=0.01):
+    Q, Q_double = DuellingDQN(STATE_SHAPE, ACTION_DIM), DuellingDQN(STATE_SHAPE, ACTION_DIM)
+    target_network = TargetNetwork(Q, Q_double, "polyak", 1, tau)
+    optimizer = torch.optim.RMSprop(Q.parameters(), lr=0.001)
+    before = {k: v.clone() for k, v in Q_double.state_dict().items()}
+    assert all(torch.equal(before[k], v) for k, v in Q.state_dict().items())
+    train_step(Q, optimizer)
+    assert torch.equal(target_network.online.flat, torch.cat([v.flatten() for v in Q.state_dict().values()]))
+    assert not all(torch.equal(before[k], v) for k, v in Q.state_dict().items())
+    target_network.update(1)
+    for k, v in Q_double.state_dict().items():
+        assert torch.allclose(v, before[k] + tau * (Q.state_dict()[k] - before[k]), atol=1e-7)
+    TargetNetwork(Q, Q_double, "hard", 2, tau)
+    assert all(torch.equal(Q_double.state_dict()[k], v) for k, v in Q.state_dict().items())
+
+    shared_params = SharedParameters(Q)
+    shared_params.publish_flat(target_network.online)
+    actor_Q = DuellingDQN(STATE_SHAPE, ACTION_DIM)
+    shared_params.load_into(actor_Q)
+    assert all(torch.equal(actor_Q.state_dict()[k], v) for k, v in Q.state_dict().items())
+    shared_params.unlink()
+    print("TargetNetwork: hard sync, Polyak update and flat publishing checks passed")
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.target_network")
+    arg_parser.add_argument("--num-calls", default=200, type=int, help="Number of calls timed per operation")
+    arg_parser.add_argument("--tau", default=0.001, type=float, help="Step size of the Polyak soft updates")
+    args = arg_parser.parse_args()
+    check()
+
+    # Per-tensor baselines on unflattened networks
+    Q, Q_double = DuellingDQN(STATE_SHAPE, ACTION_DIM), DuellingDQN(STATE_SHAPE, ACTION_DIM)
+    online_params, target_params = list(Q.parameters()), list(Q_double.parameters())
+    shared_params = SharedParameters(Q)
+    with torch.no_grad():
+        baselines = [("load_state_dict(state_dict())", lambda: Q_double.load_state_dict(Q.state_dict())),
+                     ("hard: _foreach_copy_", lambda: torch._foreach_copy_(target_params, online_params)),
+                     ("polyak: _foreach_lerp_", lambda: torch._foreach_lerp_(target_params, online_params, args.tau)),
+                     ("publish(state_dict)", lambda: shared_params.publish(Q))]
+        timings = [(name, time_per_call(fn, args.num_calls)) for name, fn in baselines]
+
+        target_network = TargetNetwork(Q, Q_double, "hard", 1, args.tau)
+        flat = [("hard: flat copy_", target_network.sync),
+                ("polyak: flat lerp_", lambda: target_network.target.flat.lerp_(target_network.online.flat, args.tau)),
+                ("publish_flat", lambda: shared_params.publish_flat(target_network.online))]
+        timings += [(name, time_per_call(fn, args.num_calls)) for name, fn in flat]
+    shared_params.unlink()
+
+    print("{:>32} {:>12}".format("operation", "us/call"))
+    for name, seconds in timings:
+        print("{:>32} {:>12.1f}".format(name, 1e6 * seconds))
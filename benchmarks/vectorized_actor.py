@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Benchmark of the frames/sec gathered by Actors on a fixed number of processes.
+Compares K Actor processes with one environment each against a single Actor process that steps K environments and
+computes their Q-values in one batched forward pass.
+Run from the root of the repository using:
+`python -m benchmarks.vectorized_actor --env-name Breakout-v0`
+"""
+import time
+import torch.multiprocessing as mp
+from argparse import ArgumentParser
+from multiprocessing.managers import BaseManager
+from actor import Actor
+from duelling_network import DuellingDQN
+from replay import ReplayMemory
+from param_sync import SharedParameters
+
+BaseManager.register("Memory", ReplayMemory)
+
+
+def benchmark(env_conf, num_procs, num_envs_per_actor, T):
+    """
+    Runs num_procs Actors with num_envs_per_actor environments each for T time steps
+    :return: Environment frames per second across all the Actors
+    """
+    actor_params = {"epsilon": 0.4,
+                    "alpha": 7,
+                    "gamma": 0.99,
+                    "num_actors": num_procs,
+                    "num_envs_per_actor": num_envs_per_actor,
+                    "n_step_transition_batch_size": 5,
+                    "shared_frame_ring_capacity": 2048,
+                    "Q_network_sync_freq": 500,
+                    "policy_network": "eager",
+                    "policy_min_action_agreement": 0.9,
+                    "print_interval": 10,
+                    "num_steps": 3,
+                    "T": T}
+    mp_manager = mp.Manager()
+    shared_state = mp_manager.dict()
+    Q = DuellingDQN(env_conf['state_shape'], env_conf['action_dim'])
+    shared_params = SharedParameters(Q)
+    shared_params.publish(Q)
+    shared_state["Q_params"] = shared_params
+    shared_mem = mp_manager.Queue()
+    replay_manager = BaseManager()
+    replay_manager.start()
+    replay_mem = replay_manager.Memory(100000, {"priority_exponent": 0.6, "importance_sampling_exponent": 0.4,
+                                                "frame_compression": None})
+    replay_mem.start_ingest(shared_mem)
+
+    actors = [Actor(i, env_conf, shared_state, shared_mem, actor_params) for i in range(num_procs)]
+    start_time = time.perf_counter()
+    [actor.start() for actor in actors]
+    [actor.join() for actor in actors]
+    elapsed = time.perf_counter() - start_time
+    for actor in actors:
+        actor.frame_ring.close()
+        actor.frame_ring.unlink()
+    shared_params.unlink()
+    replay_manager.shutdown()
+    mp_manager.shutdown()
+    return num_procs * num_envs_per_actor * T / elapsed
+
+
+if __name__ == "__main__":
+    arg_parser = ArgumentParser(prog="python -m benchmarks.vectorized_actor")
+    arg_parser.add_argument("--env-name", default="RiverraidNoFrameskip-v4", type=str)
+    arg_parser.add_argument("--num-envs", default=[1, 4, 8, 16], type=int, nargs='+',
+                            help="Number of environments K")
+    arg_parser.add_argument("--T", default=500, type=int, help="Number of time steps per environment")
+    args = arg_parser.parse_args()
+    env_conf = {"state_shape": (1, 84, 84), "action_dim": 4, "name": args.env_name, "frame_skip": 4}
+
+    results = []
+    for K in args.num_envs:
+        results.append((K, benchmark(env_conf, K, 1, args.T), benchmark(env_conf, 1, K, args.T)))
+    print("\n{:>6} {:>26} {:>26}".format("K", "K actors x 1 env (fps)", "1 actor x K envs (fps)"))
+    for K, separate_fps, batched_fps in results:
+        print("{:>6} {:>26.1f} {:>26.1f}".format(K, separate_fps, batched_fps))
@@ -0,0 +1,52 @@
+import zlib
+import threading
+
+# The fast codecs are optional. zlib from the standard library is used when neither of them is installed
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# The python-zstandard (de)compressors must not be used by several threads at once, so every thread gets its own pair
+_zstd_local = threading.local()
+
+
+def _zstd_context():
+    if not hasattr(_zstd_local, "compressor"):
+        _zstd_local.compressor = zstandard.ZstdCompressor(level=1)
+        _zstd_local.decompressor = zstandard.ZstdDecompressor()
+    return _zstd_local
+
+
+def _codecs():
+    codecs = dict()
+    if lz4_frame is not None:
+        codecs["lz4"] = (lz4_frame.compress, lz4_frame.decompress)
+    if zstandard is not None:
+        codecs["zstd"] = (lambda data: _zstd_context().compressor.compress(data),
+                          lambda data: _zstd_context().decompressor.decompress(data))
+    codecs["zlib"] = (lambda data: zlib.compress(data, 1), zlib.decompress)
+    return codecs
+
+
+CODECS = _codecs()
+
+
+def get_codec(name=None):
+    """
+    Looks up a compression codec by name. Without a name, the fastest available codec is returned in the order of
+    preference lz4, zstd, zlib
+    :param name: One of "lz4", "zstd" or "zlib" or None
+    :return: The name of the codec and its compress(bytes) and decompress(bytes) functions
+    """
+    if name is None:
+        name = next(iter(CODECS))
+    if name not in CODECS:
+        raise ValueError("Compression codec {} is not available. Available codecs: {}".format(name, list(CODECS)))
+    compress, decompress = CODECS[name]
+    return name, compress, decompress
@@ -24,5 +24,5 @@ class DuellingDQN(torch.nn.Module):
         x = x.view(-1, 64 * 7 * 7)
         value = self.value(self.value_stream_layer(x))
         advantage = self.advantage(self.advantage_stream_layer(x))
-        action_value = value + (advantage - (1/self.action_dim) * advantage.sum() )
+        action_value = value + (advantage - advantage.mean(1, keepdim=True))
         return value, advantage, action_value
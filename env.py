@@ -1,4 +1,64 @@
-import gym
+import re
+import time
+import numpy as np
+
+# Synthetic-v0 or Synthetic-<step cost in microseconds>us-v0, e.g. Synthetic-200us-v0
+SYNTHETIC_ENV_NAME = re.compile(r"^Synthetic(?:-(\d+)us)?-v0$")
+
+
+class SyntheticEnv(object):
+    def __init__(self, step_cost=0.0, episode_length=1000, num_actions=4, frame_shape=(210, 160, 3), num_frames=64,
+                 seed=0):
+        """
+        A deterministic stand-in for the Atari environments with the same reset/step interface and 210x160x3 uint8
+        frames. It needs neither gym nor the Atari ROMs, so the throughput of the Actors, replay memory and Learner can
+        be measured on any machine. The frames are drawn from a fixed set of random frames made of flat blocks, like
+        the Atari screens, and the rewards from a seeded random number generator.
+        :param step_cost: Seconds of CPU time spent on every step to emulate the cost of the Atari emulator
+        :param episode_length: Number of steps (frames) per episode
+        :param num_actions: Number of discrete actions
+        :param frame_shape: Shape of the frames (height, width, channels)
+        :param num_frames: Number of distinct frames
+        :param seed: Seed of the frames and the rewards
+        """
+        self.step_cost = step_cost
+        self.episode_length = episode_length
+        self.num_actions = num_actions
+        self.frame_shape = tuple(frame_shape)
+        self.num_frames = num_frames
+        self.t = 0
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        self.rng = np.random.RandomState(seed)
+        height, width, channels = self.frame_shape
+        blocks = self.rng.randint(0, 256, (self.num_frames, -(-height // 10), -(-width // 10), channels), dtype=np.uint8)
+        self.frames = blocks.repeat(10, axis=1).repeat(10, axis=2)[:, :height, :width]
+        return [seed]
+
+    def reset(self):
+        self.t = 0
+        return self.frames[0].copy()
+
+    def step(self, action):
+        deadline = time.perf_counter() + self.step_cost
+        self.t += 1
+        # Busy wait, like the emulator, instead of sleeping so that the Actors compete for the CPU
+        while time.perf_counter() < deadline:
+            pass
+        obs = self.frames[(self.t * (action + 1)) % self.num_frames].copy()
+        reward = float(self.rng.random_sample() < 0.05)
+        return obs, reward, self.t >= self.episode_length, {}
+
 
 def make_local_env(env_name):
-    return gym.make(env_name)
\ No newline at end of file
+    """
+    :param env_name: Name of a gym environment or of a SyntheticEnv (see SYNTHETIC_ENV_NAME)
+    :return: The environment
+    """
+    match = SYNTHETIC_ENV_NAME.match(env_name)
+    if match:
+        return SyntheticEnv(step_cost=int(match.group(1) or 0) / 1e6)
+    # gym is only needed for the real environments
+    import gym
+    return gym.make(env_name)
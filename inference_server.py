@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+import time
+import queue
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from policy_network import PolicyNetwork
+from metrics import NullMetricsWriter
+
+# Indices of the counters kept in InferenceServer.counters
+NUM_REQUESTS, NUM_BATCHES, NUM_OBSERVATIONS, TOTAL_LATENCY, TOTAL_FORWARD_TIME = range(5)
+
+
+class InferenceClient(object):
+    def __init__(self, client_id, request_queue, response_queue):
+        """
+        Handle used by an Actor to get its observations evaluated by the InferenceServer
+        :param client_id: Index of the response queue of this client in the server
+        """
+        self.client_id = client_id
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+
+    def evaluate(self, obs):
+        """
+        Sends a batch of preprocessed observations to the inference server and waits for the result
+        :param obs: numpy array of observations of shape (batch_size, *state_shape)
+        :return: The greedy actions and the Q-values for every observation
+        """
+        self.request_queue.put((self.client_id, np.asarray(obs, dtype=np.uint8), time.perf_counter()))
+        return self.response_queue.get()
+
+
+class InferenceServer(mp.Process):
+    def __init__(self, env_conf, shared_state, server_params, num_clients, metrics=None):
+        """
+        A process that holds the latest Q network parameters published by the Learner and evaluates the observations
+        sent by the Actors. Requests are gathered until max_batch_size observations are waiting or max_wait_ms has
+        passed since the first request of the batch arrived. The whole batch is evaluated with one forward pass.
+        :param env_conf: Environment configuration
+        :param shared_state: Shared state dict with the Q_params published by the Learner
+        :param server_params: Inference server parameters
+        :param num_clients: Number of InferenceClients (Actors) served
+        :param metrics: Optional MetricsWriter recording the staleness of the Q network parameters
+        """
+        super(InferenceServer, self).__init__(daemon=True)
+        self.state_shape = tuple(env_conf['state_shape'])
+        self.action_dim = env_conf['action_dim']
+        self.shared_state = shared_state
+        self.params = server_params
+        self.request_queue = mp.Queue()
+        self.response_queues = [mp.Queue() for _ in range(num_clients)]
+        self.counters = mp.Array('d', 5)  # Latency/throughput counters. See stats
+        self.metrics = metrics if metrics is not None else NullMetricsWriter()
+
+    def client(self, client_id):
+        return InferenceClient(client_id, self.request_queue, self.response_queues[client_id])
+
+    def gather_requests(self):
+        """
+        Blocks until a request arrives and then gathers more requests until the batch is full or the deadline passes
+        :return: list of (client_id, obs, send_time) requests
+        """
+        requests = [self.request_queue.get()]
+        num_obs = len(requests[0][1])
+        deadline = time.perf_counter() + self.params['max_wait_ms'] / 1000
+        while num_obs < self.params['max_batch_size']:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self.request_queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+            num_obs += len(requests[-1][1])
+        return requests
+
+    def run(self):
+        shared_params = self.shared_state["Q_params"]
+        Q = PolicyNetwork(self.state_shape, self.action_dim, self.params['policy_network'],
+                          self.params['policy_min_action_agreement'])
+        param_version = Q.load(shared_params)
+        num_batches = 0
+        while True:
+            requests = self.gather_requests()
+            forward_start = time.perf_counter()
+            obs = np.concatenate([obs for _, obs, _ in requests])
+            qS = Q(torch.from_numpy(obs).float())
+            actions = qS.argmax(1)
+            forward_end = time.perf_counter()
+            # Split the batch back into the per-client responses
+            start = 0
+            for client_id, client_obs, _ in requests:
+                end = start + len(client_obs)
+                self.response_queues[client_id].put((actions[start: end], qS[start: end]))
+                start = end
+            response_time = time.perf_counter()
+
+            with self.counters.get_lock():
+                self.counters[NUM_REQUESTS] += len(requests)
+                self.counters[NUM_BATCHES] += 1
+                self.counters[NUM_OBSERVATIONS] += len(obs)
+                self.counters[TOTAL_LATENCY] += sum(response_time - send_time for _, _, send_time in requests)
+                self.counters[TOTAL_FORWARD_TIME] += forward_end - forward_start
+            num_batches += 1
+            if num_batches % self.params['Q_network_sync_freq'] == 0:
+                # Obtain latest network parameters. Skipped if the Learner has not published new parameters
+                self.metrics.set("param_staleness", shared_params.version - param_version)
+                param_version = Q.load(shared_params, param_version)
+
+    def stats(self):
+        """
+        :return: dict with the number of requests, batches and observations served, the mean batch size, the mean
+        request latency (from the request being sent to the response being sent) and the mean forward pass time
+        """
+        with self.counters.get_lock():
+            counters = list(self.counters)
+        num_batches = max(counters[NUM_BATCHES], 1)
+        return {"requests": int(counters[NUM_REQUESTS]),
+                "batches": int(counters[NUM_BATCHES]),
+                "observations": int(counters[NUM_OBSERVATIONS]),
+                "mean_batch_size": counters[NUM_OBSERVATIONS] / num_batches,
+                "mean_latency_ms": 1000 * counters[TOTAL_LATENCY] / max(counters[NUM_REQUESTS], 1),
+                "mean_forward_ms": 1000 * counters[TOTAL_FORWARD_TIME] / num_batches}
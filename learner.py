@@ -1,53 +1,200 @@
 #!/usr/bin/env python
+import os
 import torch
 import time
+import queue
+import threading
 import numpy as np
-from collections import namedtuple
 from duelling_network import DuellingDQN
+from param_sync import SharedParameters
+from target_network import TargetNetwork
+from replay import N_Step_Transition
+from metrics import NullMetricsWriter
+
+
+class BatchPrefetcher(object):
+    def __init__(self, replay_memory, batch_size, num_workers, queue_size, metrics=None):
+        """
+        Samples and collates batches of experience in background threads so that the Learner's main loop only runs
+        the forward and backward passes. The priority updates computed by the Learner are written back to the replay
+        memory asynchronously by another background thread which merges all the pending updates into one call.
+        :param replay_memory: The (proxy of the) ReplayMemory
+        :param batch_size: Number of experiences per batch
+        :param num_workers: Number of threads sampling and collating batches
+        :param queue_size: Maximum number of collated batches waiting to be consumed by the Learner
+        :param metrics: Optional MetricsWriter recording the time spent sampling and collating
+        """
+        self.replay_memory = replay_memory
+        self.metrics = metrics if metrics is not None else NullMetricsWriter()
+        self.batch_size = batch_size
+        self.batches = queue.Queue(maxsize=queue_size)
+        self.priority_updates = queue.Queue()
+        self.stop_event = threading.Event()
+        self.error = None  # Exception that stopped the priority write-backs
+        self.threads = [threading.Thread(target=self._sample_worker, daemon=True) for _ in range(num_workers)]
+        self.threads.append(threading.Thread(target=self._priority_writer, daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def collate(self, xp_batch, is_weights):
+        """
+        Converts a sampled batch into contiguous float32 (and int64 for the actions) torch tensors. The tensors are put
+        in pinned memory when a GPU is available so that they can be copied asynchronously.
+        :param xp_batch: batch of experiences as an N_Step_Transition whose fields are numpy arrays
+        :param is_weights: importance-sampling weights of the experiences in xp_batch
+        :return: N_Step_Transition of torch tensors (the keys are kept as they are) and the is_weights tensor
+        """
+        tensors = [torch.from_numpy(np.ascontiguousarray(xp_batch.S_t)).float(),
+                   torch.from_numpy(np.ascontiguousarray(xp_batch.A_t, dtype=np.int64)),
+                   torch.from_numpy(np.ascontiguousarray(xp_batch.R_ttpB, dtype=np.float32)),
+                   torch.from_numpy(np.ascontiguousarray(xp_batch.Gamma_ttpB, dtype=np.float32)),
+                   torch.from_numpy(np.ascontiguousarray(xp_batch.qS_t, dtype=np.float32)),
+                   torch.from_numpy(np.ascontiguousarray(xp_batch.S_tpn)).float(),
+                   torch.from_numpy(np.ascontiguousarray(xp_batch.qS_tpn, dtype=np.float32)),
+                   torch.from_numpy(np.ascontiguousarray(is_weights, dtype=np.float32))]
+        if torch.cuda.is_available():
+            tensors = [tensor.pin_memory() for tensor in tensors]
+        return N_Step_Transition(*tensors[:7], key=xp_batch.key), tensors[7]
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.batches.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+
+    def _sample_worker(self):
+        try:
+            while not self.stop_event.is_set():
+                with self.metrics.timer("learner_sample_time"):
+                    xp_batch, slots, is_weights = self.replay_memory.sample(self.batch_size)
+                with self.metrics.timer("learner_collate_time"):
+                    batch = self.collate(xp_batch, is_weights) + (slots,)
+                self._put(batch)
+        except Exception as error:
+            # Handed to the Learner, which raises it from get() instead of waiting forever for a batch
+            self._put(error)
+
+    def _priority_writer(self):
+        try:
+            while not self.stop_event.is_set() or not self.priority_updates.empty():
+                try:
+                    updates = [self.priority_updates.get(timeout=0.1)]
+                except queue.Empty:
+                    continue
+                # Merge all the pending updates into a single write-back. Later updates of a slot overwrite earlier ones
+                try:
+                    while True:
+                        updates.append(self.priority_updates.get_nowait())
+                except queue.Empty:
+                    pass
+                slots, keys, priorities = [np.concatenate(arrays) for arrays in zip(*updates)]
+                self.replay_memory.set_priorities(slots, keys, priorities)
+        except Exception as error:
+            self.error = error
+            self._put(error)
+
+    def get(self):
+        """
+        :return: The next collated batch of experience, its importance-sampling weights and the slots of the experiences
+        in the replay memory. Raises the exception of a background thread that failed
+        """
+        batch = self.batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def update_priorities(self, slots, keys, priorities):
+        """
+        Queues the new priorities of the experiences to be written back to the replay memory
+        :param slots: numpy array of the slots of the experiences in the replay memory
+        :param keys: numpy array of the keys of the experiences
+        :param priorities: numpy array of the new priorities of the experiences
+        :return: None
+        """
+        self.priority_updates.put((slots, keys, priorities))
+
+    def close(self):
+        """
+        Stops the background threads after the pending priority updates are written back. Raises the exception that
+        stopped the priority write-backs, if any
+        """
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
 
-N_Step_Transition = namedtuple('N_Step_Transition', ['S_t', 'A_t', 'R_ttpB', 'Gamma_ttpB', 'qS_t', 'S_tpn', 'qS_tpn', 'key'])
 
 class Learner(object):
-    def __init__(self, env_conf, learner_params, shared_state, shared_replay_memory):
+    def __init__(self, env_conf, learner_params, shared_state, shared_replay_memory, metrics=None):
         self.state_shape = env_conf['state_shape']
         action_dim = env_conf['action_dim']
         self.params = learner_params
         self.shared_state = shared_state
+        # Records the updates/sec and the time spent waiting for batches, in the forward/backward passes and publishing
+        self.metrics = metrics if metrics is not None else NullMetricsWriter()
         self.Q = DuellingDQN(self.state_shape, action_dim)
         self.Q_double = DuellingDQN(self.state_shape, action_dim)  # Target Q network which is slow moving replica of self.Q
+        self.replay_memory = shared_replay_memory
         if self.params['load_saved_state']:
             try:
                 saved_state = torch.load(self.params['load_saved_state'])
                 self.Q.load_state_dict(saved_state['Q_state'])
             except FileNotFoundError:
                 print("WARNING: No trained model found. Training from scratch")
-        self.shared_state["Q_state_dict"] = self.Q.state_dict()
-        self.replay_memory = shared_replay_memory
-        self.optimizer = torch.optim.RMSprop(self.Q.parameters(), lr=0.00025 / 4, weight_decay=0.95, eps=1.5e-7)
+            # The replay memory snapshot saved along with the Q_state lets the training resume without refilling it
+            replay_snapshot_path = self.params['load_saved_state'] + ".replay"
+            if os.path.isdir(replay_snapshot_path):
+                num_restored = self.replay_memory.restore_snapshot(replay_snapshot_path)
+                print("Learner: Restored {} experiences from {}".format(num_restored, replay_snapshot_path))
+        # The target network is synced in place with the flattened parameters of Q. See TargetNetwork
+        self.target_network = TargetNetwork(self.Q, self.Q_double, self.params['q_target_update'],
+                                            self.params['q_target_sync_freq'], self.params['q_target_tau'])
+        # The Q network parameters are published to the Actors through shared memory straight from the flat buffer
+        self.shared_params = SharedParameters(self.Q)
+        self.shared_params.publish_flat(self.target_network.online)
+        self.shared_state["Q_params"] = self.shared_params
+        # Linear scaling rule: the learning rate grows in proportion to the batch size from the reference batch size
+        lr = self.params['learning_rate'] * self.params['replay_sample_size'] / self.params['lr_reference_batch_size']
+        self.optimizer = torch.optim.RMSprop(self.Q.parameters(), lr=lr, weight_decay=0.95, eps=1.5e-7)
         self.num_q_updates = 0
 
-    def compute_loss_and_priorities(self, xp_batch):
+    def compute_loss_and_priorities(self, xp_batch, is_weights):
         """
-        Computes the double-Q learning loss and the proportional experience priorities.
-        :param xp_batch: list of experiences of type N_Step_Transition
-        :return: double-Q learning loss and the proportional experience priorities
+        Computes the double-Q learning loss and the proportional experience priorities. The double-Q targets are
+        evaluated in inference mode. With the fused_forward parameter, S_t and S_tpn go through Q in one concatenated
+        forward pass. The backward pass then also runs over the S_tpn half of the batch, so it only pays off when the
+        forward pass of a single batch does not keep all the threads busy. See benchmarks/learner_forward.py
+        :param xp_batch: batch of experiences as an N_Step_Transition of torch tensors. See BatchPrefetcher.collate
+        :param is_weights: importance-sampling weights of the experiences in xp_batch used to correct the bias
+        introduced by the prioritized sampling
+        :return: double-Q learning loss and the proportional experience priorities as a numpy array aligned with
+        xp_batch.key
         """
-        n_step_transitions = N_Step_Transition(*zip(*xp_batch))
-        # Convert tuple to numpy array; Convert observations(S_t and S_tpn) to c x w x h torch Tensors (aka Variable)
-        S_t = torch.from_numpy(np.array(n_step_transitions.S_t)).float().requires_grad_(True)
-        S_tpn = torch.from_numpy(np.array(n_step_transitions.S_tpn)).float().requires_grad_(True)
-        rew_t_to_tpB = np.array(n_step_transitions.R_ttpB)
-        gamma_t_to_tpB = np.array(n_step_transitions.Gamma_ttpB)
-        A_t = np.array(n_step_transitions.A_t)
-
-        with torch.no_grad():
+        # Observations(S_t and S_tpn) are c x w x h torch Tensors. They do not need gradients
+        S_t = xp_batch.S_t
+        S_tpn = xp_batch.S_tpn
+        rew_t_to_tpB = xp_batch.R_ttpB
+        gamma_t_to_tpB = xp_batch.Gamma_ttpB
+        A_t = xp_batch.A_t
+
+        if self.params['fused_forward']:
+            Q_S = self.Q(torch.cat([S_t, S_tpn]))[2]
+            Q_S_t, Q_S_tpn = Q_S[: S_t.shape[0]], Q_S[S_t.shape[0]:].detach()
+        else:
+            Q_S_t = self.Q(S_t)[2]
+            with torch.inference_mode():
+                Q_S_tpn = self.Q(S_tpn)[2]
+        with torch.inference_mode():
             G_t = rew_t_to_tpB + gamma_t_to_tpB * \
-                             self.Q_double(S_tpn)[2].gather(1, torch.argmax(self.Q(S_tpn)[2], 1).view(-1, 1)).squeeze()
-        Q_S_A = self.Q(S_t)[2].gather(1, torch.from_numpy(A_t).reshape(-1, 1)).squeeze()
+                             self.Q_double(S_tpn)[2].gather(1, torch.argmax(Q_S_tpn, 1).view(-1, 1)).squeeze(1)
+        Q_S_A = Q_S_t.gather(1, A_t.reshape(-1, 1)).squeeze(1)
         batch_td_error = G_t.float() - Q_S_A
-        loss = 1/2 * (batch_td_error)**2
+        loss = 1/2 * is_weights * (batch_td_error)**2
         # Compute the new priorities of the experience
-        priorities = {k: v for k in n_step_transitions.key for v in abs(batch_td_error.detach().data.numpy())}
+        priorities = np.abs(batch_td_error.detach().numpy())
 
         return loss.mean(), priorities
 
@@ -56,25 +203,43 @@ class Learner(object):
         loss.backward()
         self.optimizer.step()
         self.num_q_updates += 1
+        self.target_network.update(self.num_q_updates)
 
-        if self.num_q_updates % self.params['q_target_sync_freq']:
-            self.Q_double.load_state_dict(self.Q.state_dict())
+    def save_state(self, path):
+        """
+        Saves the Q network parameters to path and starts writing a snapshot of the replay memory to path + ".replay"
+        in the background. Both are restored by the load_saved_state parameter
+        :param path: Path of the saved state
+        :return: None
+        """
+        torch.save({'Q_state': self.Q.state_dict()}, path)
+        self.replay_memory.save_snapshot(path + ".replay")
 
     def learn(self, T):
+        # Intra-op threads of the forward and backward passes. The torch default is used if num_threads is 0
+        if self.params['num_threads']:
+            torch.set_num_threads(self.params['num_threads'])
         while self.replay_memory.size() <=  self.params["min_replay_mem_size"]:
             time.sleep(1)
+        # 4. Prioritized batches of transitions are sampled in the background
+        prefetcher = BatchPrefetcher(self.replay_memory, int(self.params['replay_sample_size']),
+                                     self.params['prefetch_workers'], self.params['prefetch_queue_size'], self.metrics)
         for t in range(T):
-            # 4. Sample a prioritized batch of transitions
-            prioritized_xp_batch = self.replay_memory.sample(int(self.params['replay_sample_size']))
+            with self.metrics.timer("learner_wait_time"):
+                prioritized_xp_batch, is_weights, slots = prefetcher.get()
             # 5. & 7. Apply double-Q learning rule, compute loss and experience priorities
-            loss, priorities = self.compute_loss_and_priorities(prioritized_xp_batch)
-            #print("\nLearner: t=", t, "loss:", loss, "RPM.size:", self.replay_memory.size(), end='\r')
+            with self.metrics.timer("learner_forward_time"):
+                loss, priorities = self.compute_loss_and_priorities(prioritized_xp_batch, is_weights)
             # 6. Update parameters of the Q network(s)
-            self.update_Q(loss)
-            self.shared_state['Q_state_dict'] = self.Q.state_dict()
-            # 8. Update priorities
-            self.replay_memory.set_priorities(priorities)
-
-            # 9. Periodically remove old experience from replay memory
-            if t % self.params['remove_old_xp_freq'] == 0:
-                self.replay_memory.remove_to_fit()
+            with self.metrics.timer("learner_backward_time"):
+                self.update_Q(loss)
+            self.metrics.add("learner_updates")
+            if self.num_q_updates % self.params['param_publish_freq'] == 0:
+                with self.metrics.timer("learner_publish_time"):
+                    self.shared_params.publish_flat(self.target_network.online)
+            if self.params['checkpoint_freq'] and self.num_q_updates % self.params['checkpoint_freq'] == 0:
+                self.save_state(self.params['checkpoint_path'])
+            # 8. Update priorities asynchronously
+            prefetcher.update_priorities(slots, prioritized_xp_batch.key, priorities)
+            # 9. Old experience is overwritten by the replay memory in FIFO order once it is full
+        prefetcher.close()
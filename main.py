@@ -3,9 +3,11 @@ import torch
 import torch.multiprocessing as mp
 from multiprocessing.managers import BaseManager
 import json
-from replay import ReplayMemory
+from replay import ReplayMemory, ShardedReplayMemory, shard_of_actor
 from actor import Actor
 from learner import Learner
+from inference_server import InferenceServer
+from metrics import SharedMetrics, MetricsReporter
 from duelling_network import DuellingDQN
 from argparse import ArgumentParser
 
@@ -18,48 +20,78 @@ args = arg_parser.parse_args()
 BaseManager.register("Memory", ReplayMemory)
 
 
-def add_experience_to_replay_mem(shared_mem, replay_mem):
-    while 1:
-        while shared_mem.qsize() or not shared_mem.empty():
-            priorities, xp_batch = shared_mem.get()
-            replay_mem.add(priorities, xp_batch)
-
-
 if __name__ =="__main__":
     params = json.load(open(args.params_file, 'r'))
     env_conf = params['env_conf']
     actor_params = params["Actor"]
     learner_params = params["Learner"]
     replay_params = params["Replay_Memory"]
-    print("Using the params:\n env_conf:{} \n actor_params:{} \n learner_params:{} \n, replay_params:{}".format(
-        env_conf, actor_params, learner_params, replay_params))
+    inference_server_params = params["Inference_Server"]
+    metrics_params = params["Metrics"]
+    print("Using the params:\n env_conf:{} \n actor_params:{} \n learner_params:{} \n, replay_params:{} \n"
+          "inference_server_params:{} \n metrics_params:{}".format(env_conf, actor_params, learner_params,
+                                                                    replay_params, inference_server_params,
+                                                                    metrics_params))
+
+    # Every process records its metrics into its own row of a shared memory segment
+    metrics = None
+    if metrics_params["enabled"]:
+        metrics = SharedMetrics({"actor": actor_params["num_actors"], "replay": replay_params["num_shards"],
+                                 "learner": 1, "inference_server": 1, "main": 1})
+    writer = lambda role, index=0: metrics.writer(role, index) if metrics else None
 
     mp_manager = mp.Manager()
     shared_state = mp_manager.dict()
-    shared_mem = mp_manager.Queue()
-    ReplayManager = BaseManager()
-    ReplayManager.start()
-    replay_mem = ReplayManager.Memory(replay_params["soft_capacity"],  replay_params)
+    # The replay memory is split into shards, each one in its own process. Every shard gets its own queue of experience
+    num_shards = replay_params["num_shards"]
+    shared_mems = [mp_manager.Queue() for _ in range(num_shards)]
+    replay_managers = [BaseManager() for _ in range(num_shards)]
+    [replay_manager.start() for replay_manager in replay_managers]
+    replay_mem = ShardedReplayMemory([replay_manager.Memory(replay_params["soft_capacity"] // num_shards, replay_params,
+                                                           writer("replay", i))
+                                      for i, replay_manager in enumerate(replay_managers)], replay_params)
 
-    # A learner is started before the Actors so that the shared_state is populated with a Q_state_dict
-    learner = Learner(env_conf, learner_params, shared_state, replay_mem)
+    # A learner is started before the Actors so that the shared_state is populated with the Q_params
+    learner = Learner(env_conf, learner_params, shared_state, replay_mem, writer("learner"))
     learner_proc = mp.Process(target=learner.learn, args=(500000,))
     learner_proc.start()
 
+    # Optionally evaluate the Actors' observations in batches on a single inference server process
+    inference_server = None
+    if inference_server_params["enabled"]:
+        inference_server = InferenceServer(env_conf, shared_state, inference_server_params, actor_params["num_actors"],
+                                           writer("inference_server"))
+        inference_server.start()
+
     #  TODO: Test with multiple actors
     actor_procs = []
     for i in range(actor_params["num_actors"]):
-        actor_proc = Actor(i, env_conf, shared_state, shared_mem, actor_params)
+        inference_client = inference_server.client(i) if inference_server else None
+        shared_mem = shared_mems[shard_of_actor(i, num_shards)]
+        actor_proc = Actor(i, env_conf, shared_state, shared_mem, actor_params, inference_client, writer("actor", i))
         actor_proc.start()
         actor_procs.append(actor_proc)
 
-    # Run a routine in a separate proc to fetch/pre-fetch shared_replay_mem onto the ReplayBuffer for learner's use
-    replay_mem_proc = mp.Process(target=add_experience_to_replay_mem, args=(shared_mem, replay_mem))
-    replay_mem_proc.start()
+    # Run a routine in every replay memory shard's process to move the experience from the Actors' shared memory onto
+    # the ReplayBuffer for learner's use
+    replay_mem.start_ingest(shared_mems)
+
+    # Periodically aggregate the metrics of all the processes. The depth of the replay queues is sampled by the reporter
+    if metrics:
+        main_metrics = metrics.writer("main")
+        reporter = MetricsReporter(metrics, metrics_params["report_interval"], metrics_params["output_file"],
+                                   metrics_params["http_port"],
+                                   lambda: main_metrics.set("replay_queue_depth", sum(q.qsize() for q in shared_mems)))
+        reporter.start()
 
     learner_proc.join()
-    [actor_procs.join() for actor_proc in actor_procs]
-    replay_mem_proc.join()
+    [actor_proc.join() for actor_proc in actor_procs]
+    if inference_server:
+        print("Main: inference_server stats:", inference_server.stats())
+    [actor_proc.frame_ring.unlink() for actor_proc in actor_procs]
+    learner.shared_params.unlink()
+    if metrics:
+        metrics.unlink()
 
 
-    print("Main: replay_mem.size:", shared_mem.qsize())
\ No newline at end of file
+    print("Main: replay_mem.size:", replay_mem.size())
\ No newline at end of file
@@ -0,0 +1,234 @@
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+# Share a single resource tracker across all the processes. See transport.py
+resource_tracker.ensure_running()
+
+# Counters only ever increase. Their totals are summed over all the processes and reported along with their rate
+COUNTERS = ("actor_frames", "actor_transitions", "actor_bytes", "actor_episodes",
+            "replay_inserts", "replay_drops", "replay_samples", "replay_updates",
+            "learner_updates", "learner_wait_time", "learner_sample_time", "learner_collate_time",
+            "learner_forward_time", "learner_backward_time", "learner_publish_time")
+# Gauges hold the last value set by every process. Their mean and maximum over the processes are reported
+GAUGES = ("param_staleness", "replay_size", "replay_queue_depth")
+# Histograms of durations with log2 buckets: bucket b counts the durations in [2**b, 2**(b+1)) microseconds
+HISTOGRAMS = ("replay_insert_latency", "replay_sample_latency", "replay_update_latency")
+NUM_BUCKETS = 32
+
+COUNTER_INDEX = {name: i for i, name in enumerate(COUNTERS)}
+GAUGE_INDEX = {name: len(COUNTERS) + i for i, name in enumerate(GAUGES)}
+HISTOGRAM_INDEX = {name: len(COUNTERS) + len(GAUGES) + i * (NUM_BUCKETS + 1) for i, name in enumerate(HISTOGRAMS)}
+ROW_SIZE = len(COUNTERS) + len(GAUGES) + len(HISTOGRAMS) * (NUM_BUCKETS + 1)
+
+
+class SharedMetrics(object):
+    def __init__(self, roles, name=None):
+        """
+        Counters, gauges and latency histograms of all the processes in a multiprocessing shared memory segment.
+        Every process (Actor, replay memory shard, Learner, ...) writes to its own row through a MetricsWriter, so the
+        processes never contend for a lock, and the rows are aggregated when the metrics are read.
+        :param roles: A dictionary with role: number_of_processes key-value pairs, e.g. {"actor": 4, "learner": 1}
+        :param name: Name of an existing segment to attach to. A new segment is created if None
+        """
+        self.roles = dict(roles)
+        self.role_offsets = dict()
+        num_rows = 0
+        for role, num_processes in self.roles.items():
+            self.role_offsets[role] = num_rows
+            num_rows += num_processes
+        self._attach(name, num_rows)
+
+    def _attach(self, name, num_rows):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=8 * num_rows * ROW_SIZE)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.values = np.ndarray((num_rows, ROW_SIZE), dtype=np.float64, buffer=self.shm.buf)
+        if name is None:
+            self.values[:] = 0.0
+            self.values[:, len(COUNTERS): len(COUNTERS) + len(GAUGES)] = np.nan  # Gauges that were never set
+
+    def __getstate__(self):
+        return {"name": self.name, "roles": self.roles}
+
+    def __setstate__(self, state):
+        self.__init__(state["roles"], state["name"])
+
+    def writer(self, role, index=0):
+        """
+        :param role: One of the roles the metrics were created with
+        :param index: Index of the process within its role
+        :return: MetricsWriter of the row of the process
+        """
+        if index >= self.roles[role]:
+            raise ValueError("Only {} processes have the role {}".format(self.roles[role], role))
+        return MetricsWriter(self, self.role_offsets[role] + index)
+
+    def read(self):
+        """
+        :return: A copy of the current values of all the rows
+        """
+        return self.values.copy()
+
+    @staticmethod
+    def summarize(previous, current, interval):
+        """
+        Aggregates the rows of two reads of the metrics taken interval seconds apart
+        :return: A JSON serializable dictionary with the totals and rates of the counters, the mean and maximum of the
+        gauges and the count, mean and percentiles (upper bounds of their log2 bucket) of the histograms over interval
+        """
+        summary = {"time": time.time(), "interval": interval, "counters": dict(), "gauges": dict(),
+                   "histograms": dict()}
+        for name, i in COUNTER_INDEX.items():
+            total = current[:, i].sum()
+            summary["counters"][name] = {"total": total, "per_sec": (total - previous[:, i].sum()) / interval}
+        for name, i in GAUGE_INDEX.items():
+            values = current[:, i][~np.isnan(current[:, i])]
+            if len(values):
+                summary["gauges"][name] = {"mean": values.mean(), "max": values.max()}
+        for name, i in HISTOGRAM_INDEX.items():
+            counts = (current[:, i: i + NUM_BUCKETS] - previous[:, i: i + NUM_BUCKETS]).sum(0)
+            count = counts.sum()
+            if count == 0:
+                continue
+            total = (current[:, i + NUM_BUCKETS] - previous[:, i + NUM_BUCKETS]).sum()
+            cumulative = np.cumsum(counts)
+            summary["histograms"][name] = {"count": count, "mean_ms": 1e3 * total / count}
+            for q in [50, 90, 99]:
+                bucket = int(np.searchsorted(cumulative, q / 100 * count))
+                summary["histograms"][name]["p{}_ms".format(q)] = 2.0 ** (bucket + 1) / 1e3
+        return summary
+
+    def close(self):
+        self.values = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+class MetricsWriter(object):
+    def __init__(self, metrics, row):
+        """
+        Updates the metrics of one process. The updates are guarded by a lock as several threads of a process (e.g.
+        the connection threads of a replay memory shard) share its row.
+        :param metrics: SharedMetrics
+        :param row: Row of the process
+        """
+        self.metrics = metrics
+        self.row = row
+        self.values = metrics.values[row]
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        return {"metrics": self.metrics, "row": self.row}
+
+    def __setstate__(self, state):
+        self.__init__(state["metrics"], state["row"])
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.values[COUNTER_INDEX[name]] += value
+
+    def set(self, name, value):
+        self.values[GAUGE_INDEX[name]] = value
+
+    def observe(self, name, seconds):
+        """
+        Adds a duration to a histogram
+        """
+        _, exponent = math.frexp(seconds * 1e6)
+        i = HISTOGRAM_INDEX[name]
+        with self.lock:
+            self.values[i + min(max(exponent - 1, 0), NUM_BUCKETS - 1)] += 1
+            self.values[i + NUM_BUCKETS] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        """
+        Adds the time spent in the with block to a counter
+        """
+        start = time.perf_counter()
+        yield
+        self.add(name, time.perf_counter() - start)
+
+
+class NullMetricsWriter(object):
+    """
+    Stands in for a MetricsWriter when the metrics are disabled
+    """
+    def add(self, name, value=1):
+        pass
+
+    def set(self, name, value):
+        pass
+
+    def observe(self, name, seconds):
+        pass
+
+    @contextmanager
+    def timer(self, name):
+        yield
+
+
+class MetricsReporter(threading.Thread):
+    def __init__(self, metrics, interval, output_file=None, http_port=None, poll=None):
+        """
+        Periodically aggregates the metrics of all the processes. Every summary (see SharedMetrics.summarize) is written
+        as a JSON line to the output file and the latest one is served as JSON on http://127.0.0.1:<http_port>/
+        :param metrics: SharedMetrics
+        :param interval: Time in seconds between two summaries
+        :param output_file: Path of the JSON lines file. The summaries are printed if None
+        :param http_port: Port of the HTTP endpoint. No endpoint is served if None
+        :param poll: Optional function called before every summary, e.g. to set gauges sampled by the reporter
+        """
+        super(MetricsReporter, self).__init__(daemon=True)
+        self.metrics = metrics
+        self.interval = interval
+        self.output_file = output_file
+        self.http_port = http_port
+        self.poll = poll
+        self.latest = dict()
+
+    def _serve(self):
+        reporter = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = json.dumps(reporter.latest).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", self.http_port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def run(self):
+        if self.http_port is not None:
+            self._serve()
+        previous, previous_time = self.metrics.read(), time.perf_counter()
+        while True:
+            time.sleep(self.interval)
+            if self.poll is not None:
+                self.poll()
+            current, current_time = self.metrics.read(), time.perf_counter()
+            self.latest = SharedMetrics.summarize(previous, current, current_time - previous_time)
+            previous, previous_time = current, current_time
+            line = json.dumps(self.latest)
+            if self.output_file is None:
+                print(line)
+            else:
+                with open(self.output_file, "a") as output:
+                    output.write(line + "\n")
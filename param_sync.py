@@ -0,0 +1,132 @@
+import time
+import numpy as np
+import torch
+from multiprocessing import shared_memory, resource_tracker
+
+HEADER_SIZE = 64  # Bytes reserved at the start of the segment for the sequence counter
+# Share a single resource tracker across all the processes. See transport.py
+resource_tracker.ensure_running()
+
+
+class FlatParameters(object):
+    def __init__(self, model):
+        """
+        Moves the parameters and buffers of a model into one contiguous float32 buffer, in state_dict order, and turns
+        them into views of it. The whole model can then be copied, averaged or published with a single operation on
+        the flat buffer instead of one per tensor. The layout matches the one of a SharedParameters of the same model.
+        :param model: torch.nn.Module whose parameters and buffers are all float32
+        """
+        tensors = dict(model.named_parameters())
+        tensors.update(model.named_buffers())
+        state_dict = model.state_dict()
+        if any(v.dtype != torch.float32 for v in state_dict.values()):
+            raise ValueError("Only models with float32 parameters and buffers can be flattened")
+        self.layout = [(k, tuple(v.shape)) for k, v in state_dict.items()]
+        self.flat = torch.empty(sum(int(np.prod(shape)) for _, shape in self.layout), dtype=torch.float32)
+        offset = 0
+        with torch.no_grad():
+            for k, shape in self.layout:
+                size = int(np.prod(shape))
+                view = self.flat[offset: offset + size].view(shape)
+                view.copy_(tensors[k])
+                tensors[k].data = view
+                offset += size
+
+
+class SharedParameters(object):
+    def __init__(self, model, name=None):
+        """
+        Versioned copy of the parameters of a model in a multiprocessing shared memory segment. The Learner publishes
+        its Q network parameters into the segment and the Actors load them from it without any (de)serialization.
+        Concurrent access is synchronized with a sequence lock: the sequence counter is odd while a publish is in
+        progress and the version of the parameters is half the sequence counter.
+        :param model: torch.nn.Module or state_dict whose parameters define the layout of the segment
+        :param name: Name of an existing segment to attach to. A new segment is created if None
+        """
+        state_dict = model.state_dict() if isinstance(model, torch.nn.Module) else model
+        self.layout = [(k, tuple(v.shape)) for k, v in state_dict.items()]
+        self._attach(name)
+
+    def _attach(self, name):
+        num_elements = sum(int(np.prod(shape)) for _, shape in self.layout)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + 4 * num_elements)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.seq = np.ndarray((1,), dtype=np.int64, buffer=self.shm.buf)
+        self.flat = np.ndarray((num_elements,), dtype=np.float32, buffer=self.shm.buf, offset=HEADER_SIZE)
+        # torch views of every parameter in the shared memory segment
+        self.views = dict()
+        offset = 0
+        for k, shape in self.layout:
+            size = int(np.prod(shape))
+            self.views[k] = torch.from_numpy(self.flat[offset: offset + size]).view(shape)
+            offset += size
+
+    def __getstate__(self):
+        return {"name": self.name, "layout": self.layout}
+
+    def __setstate__(self, state):
+        self.layout = state["layout"]
+        self._attach(state["name"])
+
+    @property
+    def version(self):
+        return int(self.seq[0]) // 2
+
+    def publish(self, model):
+        """
+        Copies the parameters of the model into the shared memory segment and bumps the version
+        :param model: torch.nn.Module with the same layout
+        :return: The new version
+        """
+        self.seq[0] += 1  # Odd: publish in progress
+        with torch.no_grad():
+            for k, v in model.state_dict().items():
+                self.views[k].copy_(v)
+        self.seq[0] += 1
+        return self.version
+
+    def publish_flat(self, flat_parameters):
+        """
+        Copies the parameters of a flattened model into the shared memory segment in a single copy and bumps the version
+        :param flat_parameters: FlatParameters with the same layout
+        :return: The new version
+        """
+        if flat_parameters.layout != self.layout:
+            raise ValueError("The layout of the flat parameters does not match the one of the shared parameters")
+        self.seq[0] += 1  # Odd: publish in progress
+        self.flat[:] = flat_parameters.flat.detach().numpy()
+        self.seq[0] += 1
+        return self.version
+
+    def load_into(self, model, last_version=-1, timeout=0.0001):
+        """
+        Copies the latest published parameters into the model unless they are the ones at last_version already.
+        Retries if a publish happened while copying.
+        :param model: torch.nn.Module with the same layout
+        :param last_version: Version of the parameters currently in the model
+        :param timeout: Time in seconds to sleep while a publish is in progress
+        :return: The version of the parameters in the model
+        """
+        state_dict = model.state_dict()
+        while True:
+            seq = int(self.seq[0])
+            if seq % 2:
+                time.sleep(timeout)
+                continue
+            if seq // 2 == last_version:
+                return last_version
+            with torch.no_grad():
+                for k, v in state_dict.items():
+                    v.copy_(self.views[k])
+            if int(self.seq[0]) == seq:
+                return seq // 2
+
+    def close(self):
+        self.seq = self.flat = self.views = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -0,0 +1,135 @@
+import warnings
+import torch
+from duelling_network import DuellingDQN
+
+POLICY_NETWORKS = ("eager", "traced", "quantized")
+
+
+class PolicyNetwork(object):
+    def __init__(self, state_shape, action_dim, mode, min_action_agreement, probe_size=16):
+        """
+        The Q network used by the Actors and the InferenceServer to evaluate their observations. The parameters
+        published by the Learner are loaded into an fp32 DuellingDQN. In the "traced" and "quantized" modes, it is
+        TorchScript-traced once, with the Linear layers dynamically quantized to int8 in the "quantized" mode, on the
+        first evaluation and the traced module is used instead. The traced module shares the storage of the fp32
+        parameters that are not quantized, so that a parameter sync updates it in place. Only the int8 Linear weights
+        are quantized again on the first evaluation after a sync.
+        The quantized weights are then checked by comparing the greedy actions on the most recent observations with the
+        ones of the fp32 network. If they agree on less than min_action_agreement of the observations, the fp32 network
+        is used until the next parameter sync. The first quantization happens before any observation is seen and is
+        not checked.
+        :param state_shape: Shape of the observations
+        :param action_dim: Number of actions
+        :param mode: One of POLICY_NETWORKS
+        :param min_action_agreement: Fraction of the greedy actions that have to match for the int8 weights to be used
+        :param probe_size: Number of recent observations kept for the accuracy check
+        """
+        if mode not in POLICY_NETWORKS:
+            raise ValueError("The policy network is one of {}. Got: {}".format(POLICY_NETWORKS, mode))
+        self.state_shape = tuple(state_shape)
+        self.mode = mode
+        self.min_action_agreement = min_action_agreement
+        self.Q = DuellingDQN(self.state_shape, action_dim).eval()
+        self.compiled = None
+        self.use_compiled = True  # False while the int8 weights fail the accuracy check
+        self.stale = True  # The int8 weights were not quantized from the latest parameters
+        self.probe = torch.zeros((probe_size,) + self.state_shape)
+        self.num_probes = 0
+        self.next_probe = 0  # Index of the probe overwritten next
+        self.action_agreement = self.max_q_error = None  # Results of the latest accuracy check
+
+    def __getstate__(self):
+        # TorchScript modules are not picklable. The module is traced again on the first evaluation after unpickling
+        state = self.__dict__.copy()
+        state.update(compiled=None, stale=True)
+        return state
+
+    def load(self, shared_params, last_version=-1):
+        """
+        Loads the latest parameters published by the Learner unless the ones at last_version are loaded already
+        :param shared_params: SharedParameters of the Learner's Q network
+        :param last_version: Version of the parameters currently loaded
+        :return: The version of the loaded parameters
+        """
+        version = shared_params.load_into(self.Q, last_version)
+        if version != last_version:
+            self.stale = True
+        return version
+
+    def quantize(self):
+        """
+        :return: A copy of the fp32 network with the Linear layers dynamically quantized to int8
+        """
+        return torch.ao.quantization.quantize_dynamic(self.Q, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def trace(self):
+        """
+        Traces the fp32 network, or its int8 quantized copy, with the parameters that are not quantized shared with
+        the fp32 network
+        :return: The traced module
+        """
+        model = self.Q
+        if self.mode == "quantized":
+            model = self.quantize()
+            for name, _ in list(model.named_parameters()):
+                module_name, _, param_name = name.rpartition('.')
+                setattr(model.get_submodule(module_name), param_name, self.Q.get_parameter(name))
+        return torch.jit.trace(model, torch.zeros((1,) + self.state_shape))
+
+    def requantize(self):
+        """
+        Replaces the int8 weights of the traced module with the ones quantized from the latest parameters
+        """
+        for name, module in self.quantize().named_modules():
+            if isinstance(module, torch.ao.nn.quantized.dynamic.Linear):
+                self.compiled.get_submodule(name)._packed_params._packed_params = module._packed_params._packed_params
+
+    def check(self):
+        """
+        Compares the greedy actions of the traced module on the most recent observations with the fp32 network's
+        :return: True if they agree on at least min_action_agreement of the observations
+        """
+        if not self.num_probes:
+            return True
+        probe = self.probe[: self.num_probes]
+        with torch.inference_mode():
+            q, compiled_q = self.Q(probe)[2], self.compiled(probe)[2]
+        self.action_agreement = (q.argmax(1) == compiled_q.argmax(1)).float().mean().item()
+        self.max_q_error = (q - compiled_q).abs().max().item()
+        if self.action_agreement < self.min_action_agreement:
+            print("WARNING: The {} policy network agrees with the fp32 one on {:.3f} of the greedy actions. Using the "
+                  "fp32 one until the next sync".format(self.mode, self.action_agreement))
+            return False
+        return True
+
+    def refresh(self):
+        # torch.jit and the quantized tensors are deprecated in favour of torch.compile and torchao, which need a C++
+        # toolchain or an extra dependency on the Actor nodes and compile for much longer
+        with warnings.catch_warnings(), torch.no_grad():
+            warnings.simplefilter("ignore", FutureWarning)
+            warnings.filterwarnings("ignore", message=".*quantized tensor creation functions", category=UserWarning)
+            if self.compiled is None:
+                self.compiled = self.trace()
+            elif self.mode == "quantized":
+                self.requantize()
+        # The traced fp32 module runs the same ops on the same parameters as the fp32 network
+        if self.mode == "quantized":
+            self.use_compiled = self.check()
+
+    def __call__(self, obs):
+        """
+        :param obs: float tensor of observations of shape (batch_size, *state_shape)
+        :return: numpy array with the Q-values of the observations
+        """
+        if self.mode != "eager" and self.stale:
+            self.refresh()
+            self.stale = False
+        with torch.inference_mode():
+            q = (self.compiled if self.compiled is not None and self.use_compiled else self.Q)(obs)[2]
+        if self.mode == "quantized":
+            # Keep the most recent observations for the accuracy check
+            n = min(len(obs), len(self.probe))
+            self.probe[(torch.arange(n) + self.next_probe) % len(self.probe)] = obs[-n:]
+            self.next_probe = (self.next_probe + n) % len(self.probe)
+            self.num_probes = min(self.num_probes + n, len(self.probe))
+        return q.numpy()
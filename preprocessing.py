@@ -0,0 +1,75 @@
+import cv2
+import numpy as np
+
+
+class MaxPoolFrameSkip(object):
+    def __init__(self, env, frame_skip):
+        """
+        Wraps an environment (like the NoFrameskip Atari environments) so that every action is repeated frame_skip times.
+        The rewards are summed and the observation is the pixel-wise maximum of the last two frames, which removes the
+        flickering of the Atari sprites.
+        :param env: Environment with the gym reset/step interface
+        :param frame_skip: Number of frames per action
+        """
+        self.env = env
+        self.frame_skip = frame_skip
+        self.max_frame = None  # Preallocated on the first step
+
+    def reset(self):
+        return self.env.reset()
+
+    def step(self, action):
+        total_reward = 0.0
+        prev_obs = obs = None
+        for _ in range(self.frame_skip):
+            prev_obs = obs
+            obs, reward, done, info = self.env.step(action)
+            total_reward += reward
+            if done:
+                break
+        if prev_obs is None:
+            return obs, total_reward, done, info
+        if self.max_frame is None:
+            self.max_frame = np.empty_like(obs)
+        np.maximum(prev_obs, obs, out=self.max_frame)
+        return self.max_frame, total_reward, done, info
+
+
+class ObservationPreprocessor(object):
+    def __init__(self, state_shape):
+        """
+        Converts the RGB frames of an environment into the observations used by the Q network: grey scale frames area
+        resized to state_shape[1:] and stacked along the first axis to the state_shape[0] most recent frames. All the
+        intermediate results are written into preallocated uint8 buffers.
+        :param state_shape: Shape of the observation (num_stacked_frames, height, width)
+        """
+        self.state_shape = tuple(state_shape)
+        self.grey = None  # Preallocated once the size of the frames is known
+        self.resized = np.empty(self.state_shape[1:], dtype=np.uint8)
+        self.stack = np.zeros(self.state_shape, dtype=np.uint8)
+
+    def _grey_resize(self, frame):
+        if self.grey is None:
+            self.grey = np.empty(frame.shape[:2], dtype=np.uint8)
+        cv2.cvtColor(np.asarray(frame, dtype=np.uint8), cv2.COLOR_RGB2GRAY, dst=self.grey)
+        # cv2 takes the size as (width, height)
+        cv2.resize(self.grey, self.state_shape[:0:-1], dst=self.resized, interpolation=cv2.INTER_AREA)
+        return self.resized
+
+    def reset(self, frame):
+        """
+        Starts a new episode by filling the frame stack with the first frame
+        :param frame: First RGB frame of the episode
+        :return: The observation as a new uint8 array of shape state_shape
+        """
+        self.stack[:] = self._grey_resize(frame)
+        return self.stack.copy()
+
+    def __call__(self, frame):
+        """
+        :param frame: RGB frame of shape (height, width, 3)
+        :return: The observation as a new uint8 array of shape state_shape
+        """
+        self.stack[:-1] = self.stack[1:]
+        self.stack[-1] = self._grey_resize(frame)
+        return self.stack.copy()
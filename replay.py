@@ -1,84 +1,654 @@
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+import threading
 import numpy as np
+from compression import get_codec
+from transport import start_ingest_thread
+from metrics import NullMetricsWriter
+from snapshot import SnapshotReader, restored_keys, load_frames, start_snapshot_thread, start_frame_loader_thread
 
 
 N_Step_Transition = namedtuple('N_Step_Transition', ['S_t', 'A_t', 'R_ttpB', 'Gamma_ttpB', 'qS_t', 'S_tpn', 'qS_tpn', 'key'])
+KEY_SEQ_NUM_BITS = 40  # Number of low bits of a key holding the sequence number. The high bits hold the source id
+
+
+def pack_key(source_id, seq_num):
+    """
+    Packs the id of the source (actor) and the per-source sequence number into a single integer key
+    :param source_id: id of the actor that generated the frame/experience
+    :param seq_num: sequence number of the frame/experience within the source
+    :return: The packed integer key
+    """
+    return (source_id << KEY_SEQ_NUM_BITS) | seq_num
+
+
+class SumTree(object):
+    def __init__(self, capacity, operation=np.add, neutral_element=0.0):
+        """
+        Implements an array backed segment tree over `capacity` leaves. Every internal node holds operation(left, right)
+        of its children so that the reduction over all the leaves is available at the root in O(1) and a leaf can be
+        updated in O(log N). With the default np.add operation, this is the sum-tree used for proportional
+        prioritization in the (Ape-X) prioritized replay.
+        :param capacity: Number of leaves. Rounded up to the next power of 2 so that all the leaves are at the same depth
+        :param operation: A numpy ufunc used to combine the values of two child nodes
+        :param neutral_element: Value of an empty leaf such that operation(x, neutral_element) == x
+        """
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.operation = operation
+        self.neutral_element = neutral_element
+        self.tree = np.full(2 * self.capacity, neutral_element, dtype=np.float64)
+
+    def update(self, indices, values):
+        """
+        Sets the value of the leaves at indices and propagates the change to the root. All the leaves in a batch are at
+        the same depth, so each level of the tree is updated with a single vectorized operation.
+        :param indices: Leaf indices in [0, capacity)
+        :param values: New values of the leaves
+        :return: None
+        """
+        nodes = np.asarray(indices, dtype=np.int64) + self.capacity
+        if nodes.size == 0:
+            return
+        self.tree[nodes] = values
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self.tree[nodes] = self.operation(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+            nodes = np.unique(nodes // 2)
+
+    def find_prefixsum_idx(self, prefixsums):
+        """
+        Finds, for every value in prefixsums, the highest leaf index i such that sum(leaves[:i]) <= prefixsum.
+        Only meaningful for a sum-tree. Subtrees with a zero sum are never entered so empty leaves are never returned.
+        :param prefixsums: numpy array of values in [0, total())
+        :return: numpy array of leaf indices
+        """
+        prefixsums = np.array(prefixsums, dtype=np.float64)
+        nodes = np.ones(prefixsums.shape[0], dtype=np.int64)
+        while nodes[0] < self.capacity:
+            left = 2 * nodes
+            left_sum = self.tree[left]
+            go_right = (prefixsums >= left_sum) & (self.tree[left + 1] > 0)
+            prefixsums = np.where(go_right, prefixsums - left_sum, prefixsums)
+            nodes = np.where(go_right, left + 1, left)
+        return nodes - self.capacity
+
+    def total(self):
+        """
+        :return: Reduction of all the leaves using the tree's operation
+        """
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices, dtype=np.int64) + self.capacity]
+
+
+class FramePool(object):
+    def __init__(self, frame_shape, capacity):
+        """
+        Stores every observation frame once and lets the experiences in the replay memory refer to it by its slot.
+        Frames are reference counted and their slot is recycled as soon as no experience refers to them.
+        The pool grows by 50% whenever it runs out of free slots.
+        :param frame_shape: Shape of a single observation frame
+        :param capacity: Initial number of frame slots
+        """
+        self.frame_shape = tuple(frame_shape)
+        self.frames = self._new_frames(capacity)
+        self.ref_counts = np.zeros(capacity, dtype=np.int64)
+        self.slot_keys = np.zeros(capacity, dtype=np.int64)
+        self.free_slots = list(range(capacity - 1, -1, -1))  # Used as a stack
+        self.key_to_slot = dict()  # Maps the frame key generated by the actor to the slot in the pool
+        self.snapshot = None  # SnapshotReader of the snapshot that the pool was restored from, until it is fully loaded
+        self.unloaded = None  # Marks the restored slots whose frame has not been decompressed from the snapshot yet
+
+    def _new_frames(self, num_slots):
+        return np.zeros((num_slots,) + self.frame_shape, dtype=np.uint8)
+
+    def _grow(self):
+        capacity = len(self.slot_keys)
+        new_capacity = capacity + max(capacity // 2, 1)
+        self.frames = np.concatenate([self.frames, self._new_frames(new_capacity - capacity)])
+        self.ref_counts = np.concatenate([self.ref_counts, np.zeros(new_capacity - capacity, dtype=np.int64)])
+        self.slot_keys = np.concatenate([self.slot_keys, np.zeros(new_capacity - capacity, dtype=np.int64)])
+        self.free_slots.extend(range(new_capacity - 1, capacity - 1, -1))
+        if self.unloaded is not None:
+            self.unloaded = np.concatenate([self.unloaded, np.zeros(new_capacity - capacity, dtype=bool)])
+
+    def add(self, frames):
+        """
+        Copies the frames that are not in the pool yet into free slots. The new frames start with a reference count of 0
+        :param frames: A dictionary with frame_key: frame key-value pairs
+        :return: slots of the new frames
+        """
+        new_slots, new_frames = [], []
+        for key, frame in frames.items():
+            if key in self.key_to_slot:
+                continue
+            if not self.free_slots:
+                self._grow()
+            slot = self.free_slots.pop()
+            self.slot_keys[slot] = key
+            self.key_to_slot[key] = slot
+            new_slots.append(slot)
+            new_frames.append(frame)
+        new_slots = np.array(new_slots, dtype=np.int64)
+        self.store(new_slots, new_frames)
+        if self.unloaded is not None:
+            self.unloaded[new_slots] = False
+        return new_slots
+
+    def store(self, slots, frames):
+        """
+        Writes frames into the given slots
+        :param slots: numpy array of slots
+        :param frames: sequence of frames of shape frame_shape
+        :return: None
+        """
+        for slot, frame in zip(slots.tolist(), frames):
+            self.frames[slot] = frame
+
+    def get(self, slots, cache=True):
+        """
+        :param slots: numpy array of slots
+        :param cache: Whether the frames may be cached. See CompressedFramePool
+        :return: uint8 numpy array with the frames in the given slots
+        """
+        return self.frames[slots]
+
+    def nbytes(self):
+        """
+        :return: Number of bytes taken by the frames
+        """
+        return self.frames.nbytes
+
+    def lookup(self, keys):
+        """
+        :param keys: frame keys
+        :return: numpy array with the slot of every frame key or -1 if the frame is not in the pool
+        """
+        return np.array([self.key_to_slot.get(k, -1) for k in keys], dtype=np.int64)
+
+    def incref(self, slots):
+        np.add.at(self.ref_counts, slots, 1)
+
+    def decref(self, slots):
+        np.subtract.at(self.ref_counts, slots, 1)
+        self.free_unreferenced(slots)
+
+    def free_unreferenced(self, slots):
+        """
+        Returns the slots among the given slots that are no longer referred to by any experience to the pool
+        :param slots: candidate slots
+        :return: None
+        """
+        slots = np.unique(slots)
+        for slot in slots[self.ref_counts[slots] == 0].tolist():
+            del self.key_to_slot[int(self.slot_keys[slot])]
+            self.free_slots.append(slot)
+
+    def load(self, slots):
+        """
+        Decompresses the frames of the given slots from the snapshot that the pool was restored from, if they are not
+        loaded yet. See ReplayMemory.restore_snapshot
+        :param slots: slots about to be read
+        :return: None
+        """
+        if self.snapshot is None:
+            return
+        for chunk in np.unique(np.asarray(slots) // self.snapshot.chunk_size).tolist():
+            if self.is_pending(chunk):
+                self.write_chunk(chunk, self.snapshot.read_chunk(chunk))
+
+    def is_pending(self, chunk):
+        start = chunk * self.snapshot.chunk_size
+        return bool(self.unloaded[start: start + self.snapshot.chunk_size].any())
+
+    def write_chunk(self, chunk, frames):
+        """
+        Copies the frames of a decompressed snapshot chunk into the slots that still wait for them. Slots that were
+        recycled for new frames since the restore are left untouched.
+        """
+        start = chunk * self.snapshot.chunk_size
+        pending = np.flatnonzero(self.unloaded[start: start + len(frames)])
+        self.store(start + pending, frames[pending])
+        self.unloaded[start + pending] = False
+
+    def size(self):
+        return len(self.key_to_slot)
+
+
+class CompressedFramePool(FramePool):
+    def __init__(self, frame_shape, capacity, codec, num_threads, cache_size):
+        """
+        A FramePool that keeps every frame compressed on its own so that large replay capacities fit in memory.
+        Batches of frames are compressed and decompressed by a pool of threads (the codecs release the GIL) and the
+        most recently read frames are kept decompressed in an LRU cache, which absorbs the frequently sampled frames of
+        the high priority experiences. The cache is a preallocated array of frames so that the cached frames of a batch
+        are gathered with one vectorized copy.
+        :param frame_shape: Shape of a single observation frame
+        :param capacity: Initial number of frame slots
+        :param codec: Name of the compression codec. See compression.get_codec
+        :param num_threads: Number of threads compressing and decompressing the frames
+        :param cache_size: Maximum number of decompressed frames kept in the LRU cache
+        """
+        self.codec, self.compress, self.decompress = get_codec(codec)
+        self.num_threads = num_threads
+        self.executor = ThreadPoolExecutor(max_workers=num_threads) if num_threads > 1 else None
+        super(CompressedFramePool, self).__init__(frame_shape, capacity)
+        self.cache_size = cache_size
+        self.cache_frames = np.empty((cache_size,) + self.frame_shape, dtype=np.uint8)
+        self.cache_slots = np.full(cache_size, -1, dtype=np.int64)  # Frame slot held by every cache entry
+        self.cache_last_used = np.zeros(cache_size, dtype=np.int64)
+        self.free_cache_entries = list(range(cache_size))
+        self.slot_cache_entries = np.full(capacity, -1, dtype=np.int64)  # Cache entry of every frame slot or -1
+        self.num_gets = 0  # Clock of the LRU cache
+
+    def _new_frames(self, num_slots):
+        return np.array([None] * num_slots, dtype=object)
+
+    def _grow(self):
+        super(CompressedFramePool, self)._grow()
+        self.slot_cache_entries = np.concatenate([self.slot_cache_entries, np.full(
+            len(self.slot_keys) - len(self.slot_cache_entries), -1, dtype=np.int64)])
+
+    def _map(self, fn, indices):
+        # Splits the work into one batch per thread. Small batches are not worth the hand-off to the threads
+        if self.executor is None or len(indices) < 2 * self.num_threads:
+            fn(indices)
+        else:
+            list(self.executor.map(fn, np.array_split(indices, self.num_threads)))
+
+    def _uncache(self, slots):
+        entries = self.slot_cache_entries[slots]
+        entries = entries[entries >= 0]
+        self.slot_cache_entries[self.cache_slots[entries]] = -1
+        self.cache_slots[entries] = -1
+        self.free_cache_entries.extend(entries.tolist())
+
+    def _cache(self, slots, frames):
+        if len(slots) > self.cache_size:
+            slots, frames = slots[:self.cache_size], frames[:self.cache_size]
+        if len(self.free_cache_entries) < len(slots):
+            # Evict the least recently used entries. Up to an eighth of the cache is evicted at once to amortize the
+            # search, but never more entries than are in use
+            used = np.flatnonzero(self.cache_slots >= 0)
+            num_evicted = min(max(len(slots) - len(self.free_cache_entries), self.cache_size // 8), len(used))
+            evicted = used[np.argpartition(self.cache_last_used[used], num_evicted - 1)[:num_evicted]]
+            self._uncache(self.cache_slots[evicted])
+        entries = np.array(self.free_cache_entries[-len(slots):], dtype=np.int64)
+        del self.free_cache_entries[-len(slots):]
+        self.cache_frames[entries] = frames
+        self.cache_slots[entries] = slots
+        self.cache_last_used[entries] = self.num_gets
+        self.slot_cache_entries[slots] = entries
+
+    def store(self, slots, frames):
+        def compress(indices):
+            for i in indices:
+                self.frames[slots[i]] = self.compress(np.ascontiguousarray(frames[i], dtype=np.uint8))
+        self._map(compress, np.arange(len(slots)))
+        if self.cache_size > 0:
+            self._uncache(slots)
+
+    def get(self, slots, cache=True):
+        self.num_gets += 1
+        frames = np.empty((len(slots),) + self.frame_shape, dtype=np.uint8)
+        entries = self.slot_cache_entries[slots]
+        hits = entries >= 0
+        frames[hits] = self.cache_frames[entries[hits]]
+        self.cache_last_used[entries[hits]] = self.num_gets
+        # Frames shared by consecutive experiences are only decompressed once
+        missed_slots, inverse = np.unique(slots[~hits], return_inverse=True)
+        missed_frames = np.empty((len(missed_slots),) + self.frame_shape, dtype=np.uint8)
+
+        def decompress(indices):
+            for i in indices:
+                data = self.frames[missed_slots[i]]
+                if data is None:  # A slot that never held a frame
+                    missed_frames[i] = 0
+                else:
+                    missed_frames[i] = np.frombuffer(self.decompress(data), dtype=np.uint8).reshape(self.frame_shape)
+        self._map(decompress, np.arange(len(missed_slots)))
+        frames[~hits] = missed_frames[inverse]
+        if cache and self.cache_size > 0 and len(missed_slots) > 0:
+            self._cache(missed_slots, missed_frames)
+        return frames
+
+    def nbytes(self):
+        """
+        :return: Number of bytes taken by the compressed frames
+        """
+        return sum(len(data) for data in self.frames if data is not None)
 
 
 class ReplayMemory(object):
-    def __init__(self, soft_capacity, params):
+    def __init__(self, soft_capacity, params, metrics=None):
+        """
+        Implements the prioritized replay memory as a fixed capacity ring buffer. Every field of the N_Step_Transition
+        is stored in its own preallocated numpy array which is allocated when the first batch of experiences arrives.
+        New experiences overwrite the oldest ones in place once the memory is full.
+        The observations (S_t and S_tpn) are stored once in a reference counted FramePool and the experiences only
+        hold the slots of their frames in the pool. The observations are put back into the experiences at sample time.
+        With the frame_compression parameter set, the frames are compressed in a CompressedFramePool.
+        :param soft_capacity: Maximum number of experiences held in the replay memory
+        :param params: Replay memory parameters
+        :param metrics: Optional MetricsWriter recording the latency of add, sample and set_priorities
+        """
         self.soft_capacity = soft_capacity
-        self.memory = list()
-        self.mem_idx = 0
-        self.counter = 0
+        self.memory = None  # N_Step_Transition of numpy arrays with one row per slot. Allocated on the first add
+        self.frame_pool = None
+        self.counter = 0  # Insertion count of the next experience to be added
         self.alpha = params['priority_exponent']
-        self.priorities = dict()
-        self.sample_probabilities = dict()
+        self.beta = params['importance_sampling_exponent']
+        self.priority_sum = SumTree(soft_capacity)
+        self.priority_min = SumTree(soft_capacity, np.minimum, np.inf)
+        self.params = params
+        self.metrics = metrics if metrics is not None else NullMetricsWriter()
+        # The BaseManager serves every client connection in its own thread
+        self.lock = threading.Lock()
+        self.snapshot_thread = None
 
-    def update_sample_probabilities(self):
-        """
-        Updates the probability of sampling an experience from the replay memory
-        :return:
+    def _allocate(self, q_shape, frame_shape, frame_pool_capacity=None):
+        # Every experience brings about one new frame as consecutive experiences share their S_tpn and S_t frames
+        if frame_pool_capacity is None:
+            frame_pool_capacity = self.soft_capacity + self.soft_capacity // 8
+        if self.params['frame_compression']:
+            self.frame_pool = CompressedFramePool(frame_shape, frame_pool_capacity, self.params['frame_compression'],
+                                                  self.params['decompression_threads'],
+                                                  self.params['frame_cache_size'])
+        else:
+            self.frame_pool = FramePool(frame_shape, frame_pool_capacity)
+        self.memory = N_Step_Transition(S_t=np.full(self.soft_capacity, -1, dtype=np.int64),
+                                        A_t=np.zeros(self.soft_capacity, dtype=np.int64),
+                                        R_ttpB=np.zeros(self.soft_capacity, dtype=np.float32),
+                                        Gamma_ttpB=np.zeros(self.soft_capacity, dtype=np.float32),
+                                        qS_t=np.zeros((self.soft_capacity,) + q_shape, dtype=np.float32),
+                                        S_tpn=np.full(self.soft_capacity, -1, dtype=np.int64),
+                                        qS_tpn=np.zeros((self.soft_capacity,) + q_shape, dtype=np.float32),
+                                        key=np.full(self.soft_capacity, -1, dtype=np.int64))
+
+    def set_priorities(self, slots, keys, priorities):
         """
-        priorities = self.priorities
-        prob = [p**self.alpha/ sum(priorities.values())  for p in priorities.values()]
-        prob /= sum(prob)
-        self.sample_probabilities.update({k:v for k in list(priorities) for v in prob})
-        # Let the probabilities sum to 1
-        sum_of_prob = sum(self.sample_probabilities.values())
-        for k in self.sample_probabilities.keys():
-            self.sample_probabilities[k] /= sum_of_prob
-
-    def set_priorities(self, new_priorities):
-        """
-        Updates the priorities of experience using the key that uniquely identifies an experience.
-        If a key does not exist, it is added. If a key already exists, the priority value is updated/overwritten.
-        Whenever the priorities are altered/added, the sample probabilities are also updated.
-        :param priorities: A dictionary with experience_key: priority_value key-value pairs
+        Updates the priorities of sampled experiences with a single vectorized scatter into the sum-tree.
+        An experience is identified by its slot and its unique key. Experiences whose slot has been overwritten by newer
+        experience since they were sampled no longer match their key and are ignored.
+        :param slots: numpy array of the slots of the experiences as returned by sample
+        :param keys: numpy array of the (packed integer) keys of the experiences
+        :param priorities: numpy array of the new priorities of the experiences
         :return: None
         """
-        self.priorities.update(new_priorities)
-        # Update the sample probabilities as well
-        self.update_sample_probabilities()
+        start = time.perf_counter()
+        slots = np.asarray(slots, dtype=np.int64)
+        keys = np.asarray(keys, dtype=np.int64)
+        with self.lock:
+            current = self.memory.key[slots] == keys
+            self._set_priorities(slots[current], np.asarray(priorities)[current])
+        self.metrics.observe("replay_update_latency", time.perf_counter() - start)
+        self.metrics.add("replay_updates", len(slots))
+
+    def _set_priorities(self, slots, priorities):
+        if slots.size == 0:
+            return
+        # A small constant keeps experiences with zero TD-error sampleable
+        p_alpha = (np.abs(np.asarray(priorities, dtype=np.float64)) + 1e-6) ** self.alpha
+        self.priority_sum.update(slots, p_alpha)
+        self.priority_min.update(slots, p_alpha)
 
     def sample(self, sample_size):
         """
         Returns a batch of experiences sampled from the replay memory based on the sampling probability calculated using
-        the experience priority
+        the experience priority. The sampling is stratified: the total priority mass is split into sample_size equal
+        segments and one experience is drawn from each segment.
         :param sample_size: Size of the batch to be sampled from the prioritized replay buffer
-        :return: A list of N_Step_Transition objects
+        :return: An N_Step_Transition whose fields are numpy arrays holding the batch of experiences, the (slot) indices
+        of the sampled experiences and their importance-sampling weights normalized by the maximum weight
         """
-        mem = N_Step_Transition(*zip(*self.memory))
-        sampled_keys = [np.random.choice(list(self.priorities.keys()), p=list(self.sample_probabilities.values()))
-                        for _ in range(sample_size) ]
-        batch_xp = [N_Step_Transition(S, A, R, G, qt, Sn, qn, key) for k in sampled_keys
-                    for S, A, R, G, qt, Sn, qn, key in zip(mem.S_t, mem.A_t, mem.R_ttpB, mem.Gamma_ttpB,
-                                                           mem.qS_t, mem.S_tpn, mem.qS_tpn, mem.key) if key == k]
-        return batch_xp
+        start = time.perf_counter()
+        with self.lock:
+            total = self.priority_sum.total()
+            segment = total / sample_size
+            prefixsums = (np.arange(sample_size) + np.random.uniform(size=sample_size)) * segment
+            slots = self.priority_sum.find_prefixsum_idx(prefixsums)
+            batch_xp = N_Step_Transition(*[field[slots] for field in self.memory])
+            frame_slots = np.concatenate([batch_xp.S_t, batch_xp.S_tpn])
+            self.frame_pool.load(frame_slots)
+            frames = self.frame_pool.get(frame_slots)
+            batch_xp = batch_xp._replace(S_t=frames[:sample_size], S_tpn=frames[sample_size:])
 
-    def add(self, priorities, xp_batch):
+            prob = self.priority_sum[slots] / total
+            min_prob = self.priority_min.total() / total
+            weights = (prob / min_prob) ** -self.beta
+        self.metrics.observe("replay_sample_latency", time.perf_counter() - start)
+        self.metrics.add("replay_samples", sample_size)
+        return batch_xp, slots, weights.astype(np.float32)
+
+    def add(self, priorities, xp_batch, frames):
         """
-        Adds batches of experiences and priorities to the replay memory
-        :param priorities: Priorities of the experiences in xp_batch
-        :param xp_batch: List of experiences of type N_Step_Transitions
+        Adds batches of experiences and priorities to the replay memory. Once the replay memory is full, the oldest
+        experiences are overwritten in FIFO order.
+        :param priorities: numpy array of the priorities of the experiences in xp_batch
+        :param xp_batch: List of experiences of type N_Step_Transitions whose S_t and S_tpn are frame keys and whose
+        key is a packed integer key. See pack_key
+        :param frames: A dictionary with frame_key: frame key-value pairs with the frames that the experiences in
+        xp_batch refer to and that were not sent to the replay memory before
         :return:
         """
-        # Add the new experience data to replay memory
-        [self.memory.append(xp) for xp in xp_batch]
-        # Set the initial priorities of the new experiences using set_priorities which also takes care of updating prob
-        self.set_priorities(priorities)
+        start = time.perf_counter()
+        num_added = self._add(priorities, xp_batch, frames)
+        self.metrics.observe("replay_insert_latency", time.perf_counter() - start)
+        self.metrics.add("replay_inserts", num_added)
+        self.metrics.set("replay_size", self.size())
+
+    def _add(self, priorities, xp_batch, frames):
+        if not xp_batch:
+            return 0
+        with self.lock:
+            if self.memory is None:
+                self._allocate(np.shape(xp_batch[0].qS_t), np.shape(next(iter(frames.values()))))
+            new_frame_slots = self.frame_pool.add(frames)
+            S_t = self.frame_pool.lookup([xp.S_t for xp in xp_batch])
+            S_tpn = self.frame_pool.lookup([xp.S_tpn for xp in xp_batch])
+            # Drop the experiences whose shared frame has already been evicted along with an older experience. This only
+            # happens when the replay memory wraps around between two batches of an Actor, so the drops are counted
+            valid = np.logical_and(S_t >= 0, S_tpn >= 0)
+            if not valid.all():
+                self.metrics.add("replay_drops", int(len(valid) - valid.sum()))
+            xp_batch = [xp for xp, is_valid in zip(xp_batch, valid) if is_valid]
+            if not xp_batch:
+                self.frame_pool.free_unreferenced(new_frame_slots)
+                return 0
+            batch = N_Step_Transition(*zip(*xp_batch))._replace(S_t=S_t[valid], S_tpn=S_tpn[valid])
+            priorities = np.asarray(priorities)[valid]
+            num_xp = len(xp_batch)
+            self.frame_pool.incref(np.concatenate([batch.S_t, batch.S_tpn]))
 
-    def remove_to_fit(self):
+            slots = np.arange(self.counter, self.counter + num_xp) % self.soft_capacity
+            self.counter += num_xp
+            # Evict the experiences that are about to be overwritten
+            evicted_frames = np.concatenate([self.memory.S_t[slots], self.memory.S_tpn[slots]])
+            self.frame_pool.decref(evicted_frames[evicted_frames >= 0])
+            # Frames that none of the experiences refer to are not kept
+            self.frame_pool.free_unreferenced(new_frame_slots)
+            self.priority_sum.update(slots, 0.0)
+            self.priority_min.update(slots, np.inf)
+
+            for field, values in zip(self.memory, batch):
+                field[slots] = values
+            # Set the initial priorities of the new experiences
+            self._set_priorities(slots, priorities)
+        return num_xp
+
+    def start_ingest(self, descriptor_queue):
         """
-        Method to remove replay memory data above the soft capacity threshold. The experiences are removed in FIFO order
-        This method is called by the learner periodically
-        :return:
+        Starts a thread in the replay memory's process that adds the experience sent by the Actors through their shared
+        memory frame rings. See transport.ingest
+        :param descriptor_queue: Queue on which the Actors put the descriptors of their experience batches
+        :return: None
+        """
+        start_ingest_thread(descriptor_queue, self)
+
+    def save_snapshot(self, path):
+        """
+        Writes the experiences, priorities and counter of the replay memory to the directory `path` in a background
+        thread. See snapshot.write_snapshot
+        :param path: Directory of the snapshot
+        :return: False if the previous snapshot is still being written and no new snapshot was started, True otherwise
+        """
+        if self.snapshot_thread is not None and self.snapshot_thread.is_alive():
+            return False
+        self.snapshot_thread = start_snapshot_thread(self, path)
+        return True
+
+    def restore_snapshot(self, path, lazy=True):
+        """
+        Replaces the contents of the replay memory with a snapshot written by save_snapshot. The experiences and their
+        priorities are restored at once. The frames are memory-mapped and decompressed chunk by chunk by a background
+        thread, and on demand by sample, so that sampling can start right away when lazy is True.
+        Experiences whose frames were recycled while the snapshot was being written are dropped. The restored
+        experiences and frames get new keys (see snapshot.restored_keys) as the restarted Actors reuse the old keys.
+        :param path: Directory of the snapshot
+        :param lazy: Whether to return before all the frames are decompressed
+        :return: Number of restored experiences
         """
-        if self.size() > self.soft_capacity:
-            num_excess_data = self.size() - self.soft_capacity
-            # FIFO
-            del self.memory[: num_excess_data]
+        snapshot = SnapshotReader(path)
+        if snapshot.meta["soft_capacity"] != self.soft_capacity:
+            raise ValueError("The replay memory snapshot in {} has a soft_capacity of {} instead of {}".format(
+                path, snapshot.meta["soft_capacity"], self.soft_capacity))
+        experiences = snapshot.experiences
+        with self.lock:
+            self._allocate(experiences['qS_t'].shape[1:], snapshot.frame_shape, snapshot.meta["frame_pool_capacity"])
+            slots = np.flatnonzero(experiences['key'] != -1)
+            valid = np.logical_and(snapshot.frame_valid[experiences['S_t'][slots]],
+                                   snapshot.frame_valid[experiences['S_tpn'][slots]])
+            slots = slots[valid]
+            for field in self.memory._fields:
+                getattr(self.memory, field)[slots] = experiences[field][slots]
+            self.memory.key[slots] = restored_keys(slots)
+            self.counter = snapshot.meta["counter"]
+            priorities = experiences['priority'][slots]
+            self.priority_sum = SumTree(self.soft_capacity)
+            self.priority_min = SumTree(self.soft_capacity, np.minimum, np.inf)
+            self.priority_sum.update(slots, priorities)
+            self.priority_min.update(slots, priorities)
+
+            frame_pool = self.frame_pool
+            frame_pool.incref(np.concatenate([self.memory.S_t[slots], self.memory.S_tpn[slots]]))
+            frame_slots = np.flatnonzero(frame_pool.ref_counts)
+            frame_pool.slot_keys[frame_slots] = restored_keys(frame_slots)
+            frame_pool.key_to_slot = dict(zip(frame_pool.slot_keys[frame_slots].tolist(), frame_slots.tolist()))
+            frame_pool.free_slots = np.flatnonzero(frame_pool.ref_counts == 0)[::-1].tolist()
+            frame_pool.unloaded = frame_pool.ref_counts > 0
+            frame_pool.snapshot = snapshot
+        if lazy:
+            start_frame_loader_thread(self)
+        else:
+            load_frames(self)
+        return len(slots)
+
+    def priority_mass(self):
+        """
+        :return: The sum and the minimum of the (exponentiated) priorities of the experiences in the replay memory
+        """
+        with self.lock:
+            return self.priority_sum.total(), self.priority_min.total()
 
     def size(self):
-        return len(self.memory)
+        return min(self.counter, self.soft_capacity)
+
+
+def shard_of_actor(actor_id, num_shards):
+    """
+    :return: Index of the replay memory shard that stores the experience of the actor
+    """
+    return actor_id % num_shards
+
+
+class ShardedReplayMemory(object):
+    def __init__(self, shards, params):
+        """
+        Presents N replay memory shards, each living in its own (BaseManager) process, as a single replay memory to the
+        Learner. Every Actor sends its experience to one shard (see shard_of_actor) so that the inserts are spread across
+        the shard processes. Batches are sampled from the shards in proportion to their total priority mass and the
+        priority updates are routed back to the shard that holds the experience.
+        The slots returned by sample are global slots: slot * num_shards + shard_index
+        :param shards: list of (proxies of) ReplayMemory
+        :param params: Replay memory parameters
+        """
+        self.shards = shards
+        self.num_shards = len(shards)
+        self.beta = params['importance_sampling_exponent']
+        self.executor = None  # Created on first use by the process that uses the shards
+        self.executor_pid = None
+
+    def _map(self, fn, items):
+        # The proxies block on the shard processes, so the shards are called concurrently from a pool of threads
+        if self.executor_pid != os.getpid():
+            self.executor = ThreadPoolExecutor(max_workers=self.num_shards)
+            self.executor_pid = os.getpid()
+        return list(self.executor.map(fn, items))
+
+    def sample(self, sample_size):
+        """
+        Draws the number of experiences to sample from every shard from a multinomial distribution over the priority
+        mass of the shards and samples the shards concurrently. The importance-sampling weights of every shard are
+        normalized by the maximum weight of that shard, so they are rescaled to the maximum weight across all the shards.
+        See ReplayMemory.sample
+        """
+        if self.num_shards == 1:
+            return self.shards[0].sample(sample_size)
+        masses = np.array(self._map(lambda shard: shard.priority_mass(), self.shards))
+        totals, minimums = masses[:, 0], masses[:, 1]
+        counts = np.random.multinomial(sample_size, totals / totals.sum())
+        sampled_shards = np.flatnonzero(counts)
+        batches = self._map(lambda i: self.shards[i].sample(int(counts[i])), sampled_shards)
+        batch_xp = N_Step_Transition(*[np.concatenate(field) for field in zip(*[batch[0] for batch in batches])])
+        slots = np.concatenate([batch[1] * self.num_shards + i for i, batch in zip(sampled_shards, batches)])
+        # (p / min_shard) ** -beta * (min / min_shard) ** beta == (p / min) ** -beta
+        weights = np.concatenate([batch[2] * (minimums.min() / minimums[i]) ** self.beta
+                                  for i, batch in zip(sampled_shards, batches)])
+        return batch_xp, slots, weights.astype(np.float32)
 
+    def set_priorities(self, slots, keys, priorities):
+        """
+        Splits the priority updates by the shard that holds the experiences. See ReplayMemory.set_priorities
+        :param slots: numpy array of global slots as returned by sample
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        shard_indices = slots % self.num_shards
+        updates = [(i, shard_indices == i) for i in np.unique(shard_indices)]
+        self._map(lambda update: self.shards[update[0]].set_priorities(slots[update[1]] // self.num_shards,
+                                                                       np.asarray(keys)[update[1]],
+                                                                       np.asarray(priorities)[update[1]]), updates)
+
+    def start_ingest(self, descriptor_queues):
+        """
+        Starts the ingest thread of every shard. See ReplayMemory.start_ingest
+        :param descriptor_queues: list with the descriptor queue of every shard
+        :return: None
+        """
+        for shard, descriptor_queue in zip(self.shards, descriptor_queues):
+            shard.start_ingest(descriptor_queue)
+
+    def save_snapshot(self, path):
+        """
+        Writes a snapshot of every shard into the sub-directory shard_<index> of path. See ReplayMemory.save_snapshot
+        :return: Whether a new snapshot was started by every shard
+        """
+        return all(self._map(lambda i: self.shards[i].save_snapshot(os.path.join(path, "shard_{}".format(i))),
+                             range(self.num_shards)))
+
+    def restore_snapshot(self, path, lazy=True):
+        """
+        Restores every shard from the sub-directory shard_<index> of path. See ReplayMemory.restore_snapshot
+        :return: Number of restored experiences across all the shards
+        """
+        shard_paths = [os.path.join(path, "shard_{}".format(i)) for i in range(self.num_shards)]
+        if not all(os.path.isdir(shard_path) for shard_path in shard_paths):
+            raise ValueError("The replay memory snapshot in {} does not have {} shards".format(path, self.num_shards))
+        return sum(self._map(lambda i: self.shards[i].restore_snapshot(shard_paths[i], lazy), range(self.num_shards)))
+
+    def size(self):
+        return sum(self._map(lambda shard: shard.size(), self.shards))
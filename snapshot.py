@@ -0,0 +1,156 @@
+import os
+import json
+import mmap
+import shutil
+import threading
+import numpy as np
+from compression import get_codec
+
+SNAPSHOT_CHUNK_SIZE = 64  # Number of frames compressed together into one chunk. Small chunks keep lazy loads cheap
+
+
+def restored_keys(slots):
+    """
+    Keys given to the restored experiences and frames. They are negative, so they never collide with the keys of the
+    experience generated by the (restarted) Actors or with the -1 of the empty slots
+    :param slots: slots of the restored experiences or frames
+    :return: numpy array of keys
+    """
+    return -2 - np.asarray(slots, dtype=np.int64)
+
+
+def write_snapshot(replay_mem, path, chunk_size=SNAPSHOT_CHUNK_SIZE, codec=None):
+    """
+    Writes the experiences, priorities and counter of a ReplayMemory to the directory `path`:
+      - meta.json: capacity, shapes, counter and the compression codec
+      - experiences.npy: a structured array with one row per slot of the replay memory (can be memory-mapped)
+      - frames.bin: the frames of the FramePool, compressed in chunks of chunk_size consecutive slots
+      - chunk_offsets.npy: byte offsets of the chunks in frames.bin
+      - frame_valid.npy: whether every frame slot still held the frame referred to by the experiences when it was copied
+    The experiences are copied at once while holding the replay memory's lock. The frames are copied chunk by chunk
+    and compressed outside of the lock so that sample and add are only blocked for the duration of one chunk copy.
+    The snapshot is written into a temporary directory which replaces `path` once it is complete.
+    :param replay_mem: ReplayMemory instance
+    :param path: Directory of the snapshot
+    :param chunk_size: Number of frames per compressed chunk
+    :param codec: Name of the compression codec. See compression.get_codec
+    :return: None
+    """
+    codec, compress, _ = get_codec(codec)
+    with replay_mem.lock:
+        if replay_mem.memory is None:
+            return
+        memory = replay_mem.memory
+        experiences = np.zeros(replay_mem.soft_capacity, dtype=[('S_t', np.int64), ('A_t', np.int64),
+                                                                 ('R_ttpB', np.float32), ('Gamma_ttpB', np.float32),
+                                                                 ('qS_t', np.float32, memory.qS_t.shape[1:]),
+                                                                 ('S_tpn', np.int64),
+                                                                 ('qS_tpn', np.float32, memory.qS_tpn.shape[1:]),
+                                                                 ('key', np.int64), ('priority', np.float64)])
+        for field in memory._fields:
+            experiences[field] = getattr(memory, field)
+        experiences['priority'] = replay_mem.priority_sum[np.arange(replay_mem.soft_capacity)]
+        slot_keys = replay_mem.frame_pool.slot_keys.copy()
+        frame_shape = replay_mem.frame_pool.frame_shape
+        meta = {"soft_capacity": replay_mem.soft_capacity,
+                "counter": replay_mem.counter,
+                "frame_shape": list(frame_shape),
+                "frame_pool_capacity": len(slot_keys),
+                "chunk_size": chunk_size,
+                "codec": codec}
+
+    tmp_path = path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, "experiences.npy"), experiences)
+    frame_valid = np.zeros(len(slot_keys), dtype=bool)
+    chunk_offsets = [0]
+    with open(os.path.join(tmp_path, "frames.bin"), "wb") as frames_file:
+        for start in range(0, len(slot_keys), chunk_size):
+            end = min(start + chunk_size, len(slot_keys))
+            with replay_mem.lock:
+                frame_pool = replay_mem.frame_pool
+                frame_pool.load(np.arange(start, end))
+                frames = frame_pool.get(np.arange(start, end), cache=False)
+                # A slot that was recycled for a new frame no longer holds the frame the experiences referred to
+                frame_valid[start:end] = frame_pool.slot_keys[start:end] == slot_keys[start:end]
+            chunk = compress(frames.tobytes())
+            frames_file.write(chunk)
+            chunk_offsets.append(chunk_offsets[-1] + len(chunk))
+    np.save(os.path.join(tmp_path, "chunk_offsets.npy"), np.array(chunk_offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_path, "frame_valid.npy"), frame_valid)
+    with open(os.path.join(tmp_path, "meta.json"), "w") as meta_file:
+        json.dump(meta, meta_file)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp_path, path)
+
+
+def start_snapshot_thread(replay_mem, path):
+    """
+    Runs write_snapshot in a daemon thread of the calling process
+    """
+    snapshot_thread = threading.Thread(target=write_snapshot, args=(replay_mem, path), daemon=True)
+    snapshot_thread.start()
+    return snapshot_thread
+
+
+class SnapshotReader(object):
+    def __init__(self, path):
+        """
+        Opens a snapshot written by write_snapshot. The experiences and the compressed frames are memory-mapped, so
+        nothing but the chunk offsets is read until the data is accessed.
+        :param path: Directory of the snapshot
+        """
+        with open(os.path.join(path, "meta.json")) as meta_file:
+            self.meta = json.load(meta_file)
+        self.frame_shape = tuple(self.meta["frame_shape"])
+        self.chunk_size = self.meta["chunk_size"]
+        self.experiences = np.load(os.path.join(path, "experiences.npy"), mmap_mode='r')
+        self.frame_valid = np.load(os.path.join(path, "frame_valid.npy"), mmap_mode='r')
+        self.chunk_offsets = np.load(os.path.join(path, "chunk_offsets.npy"))
+        self.num_chunks = len(self.chunk_offsets) - 1
+        _, _, self.decompress = get_codec(self.meta["codec"])
+        with open(os.path.join(path, "frames.bin"), "rb") as frames_file:
+            self.frames = mmap.mmap(frames_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read_chunk(self, chunk):
+        """
+        :param chunk: Index of the chunk
+        :return: numpy array with the frames of the slots [chunk * chunk_size, (chunk + 1) * chunk_size)
+        """
+        data = self.decompress(self.frames[self.chunk_offsets[chunk]: self.chunk_offsets[chunk + 1]])
+        return np.frombuffer(data, dtype=np.uint8).reshape((-1,) + self.frame_shape)
+
+    def close(self):
+        self.frames.close()
+
+
+def load_frames(replay_mem):
+    """
+    Decompresses all the chunks of the snapshot that the replay memory's FramePool was restored from. The chunks are
+    decompressed outside of the replay memory's lock and chunks which were already loaded on demand by sample are
+    skipped.
+    :param replay_mem: ReplayMemory instance restored with ReplayMemory.restore_snapshot
+    :return: None
+    """
+    frame_pool = replay_mem.frame_pool
+    snapshot = frame_pool.snapshot
+    for chunk in range(snapshot.num_chunks):
+        if not frame_pool.is_pending(chunk):
+            continue
+        frames = snapshot.read_chunk(chunk)
+        with replay_mem.lock:
+            frame_pool.write_chunk(chunk, frames)
+    with replay_mem.lock:
+        frame_pool.snapshot = None
+        frame_pool.unloaded = None
+    snapshot.close()
+
+
+def start_frame_loader_thread(replay_mem):
+    """
+    Runs load_frames in a daemon thread of the calling process
+    """
+    loader_thread = threading.Thread(target=load_frames, args=(replay_mem,), daemon=True)
+    loader_thread.start()
+    return loader_thread
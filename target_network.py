@@ -0,0 +1,48 @@
+import torch
+from param_sync import FlatParameters
+
+TARGET_UPDATES = ("hard", "polyak")
+
+
+class TargetNetwork(object):
+    def __init__(self, online, target, update, sync_freq, tau):
+        """
+        Keeps the target Q network in sync with the online Q network. Both networks are flattened (see FlatParameters)
+        so that a hard sync is a single copy and a Polyak soft update a single in-place linear interpolation of the flat
+        buffers, without building or loading any state_dict. The target is synced with the online network once here.
+        :param online: The online Q network (torch.nn.Module). Its flat buffer is available as self.online.flat
+        :param target: The target Q network with the same layout
+        :param update: "hard" to copy the online parameters every sync_freq updates or "polyak" to move the target
+        parameters by tau towards the online parameters on every update
+        :param sync_freq: Number of updates between two hard syncs
+        :param tau: Step size of the Polyak soft updates
+        """
+        if update not in TARGET_UPDATES:
+            raise ValueError("The target network update is one of {}. Got: {}".format(TARGET_UPDATES, update))
+        self.online = FlatParameters(online)
+        self.target = FlatParameters(target)
+        if self.online.layout != self.target.layout:
+            raise ValueError("The online and target networks have different layouts")
+        self.update_rule = update
+        self.sync_freq = sync_freq
+        self.tau = tau
+        self.sync()
+
+    def sync(self):
+        """
+        Copies the online parameters into the target network
+        """
+        with torch.no_grad():
+            self.target.flat.copy_(self.online.flat)
+
+    def update(self, num_updates):
+        """
+        Updates the target network after an update of the online network
+        :param num_updates: Number of updates of the online network so far
+        :return: None
+        """
+        if self.update_rule == "polyak":
+            with torch.no_grad():
+                self.target.flat.lerp_(self.online.flat, self.tau)
+        elif num_updates % self.sync_freq == 0:
+            self.sync()
@@ -0,0 +1,132 @@
+import time
+import queue
+import threading
+import traceback
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+HEADER_SIZE = 64  # Bytes reserved at the start of the segment for the write and read counters
+# Start the resource tracker before any (manager) process is forked so that all the processes share a single tracker.
+# Otherwise a process that attaches to a segment gets its own tracker which unlinks the segment when the process exits
+resource_tracker.ensure_running()
+
+
+class SharedFrameRing(object):
+    def __init__(self, frame_shape, capacity, name=None):
+        """
+        Implements a single-producer single-consumer ring of observation frames in a multiprocessing shared memory
+        segment. An Actor writes the frames of its n-step transitions into the ring and only sends a small descriptor
+        through the replay queue. The replay memory reads the frames straight out of the segment.
+        :param frame_shape: Shape of a single observation frame
+        :param capacity: Number of frame slots in the ring
+        :param name: Name of an existing segment to attach to. A new segment is created if None
+        """
+        self.frame_shape = tuple(frame_shape)
+        self.capacity = capacity
+        size = HEADER_SIZE + capacity * int(np.prod(self.frame_shape))
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.counters = np.ndarray((2,), dtype=np.int64, buffer=self.shm.buf)  # [write count, read count]
+        self.frames = np.ndarray((capacity,) + self.frame_shape, dtype=np.uint8, buffer=self.shm.buf,
+                                 offset=HEADER_SIZE)
+
+    @property
+    def spec(self):
+        """
+        :return: A small picklable tuple that can be used to attach to this ring from another process
+        """
+        return self.name, self.frame_shape, self.capacity
+
+    def put(self, frames, timeout=0.001, max_wait=300.0):
+        """
+        Writes the frames into the next slots of the ring. Blocks while the consumer has not released enough slots.
+        :param frames: list of frames
+        :param timeout: Time in seconds to sleep between checks for free slots
+        :param max_wait: Time in seconds after which a consumer that has not released enough slots is considered dead
+        :return: The write count of the first frame which is used by the consumer to locate the frames
+        """
+        num_frames = len(frames)
+        assert num_frames <= self.capacity, "More frames than the capacity of the shared frame ring"
+        write_count = int(self.counters[0])
+        deadline = None
+        while write_count + num_frames - self.counters[1] > self.capacity:
+            if deadline is None:
+                deadline = time.time() + max_wait
+            elif time.time() > deadline:
+                raise RuntimeError("The replay memory has not released any slot of the shared frame ring {} for {} "
+                                   "seconds".format(self.name, max_wait))
+            time.sleep(timeout)
+        for i, frame in enumerate(frames):
+            self.frames[(write_count + i) % self.capacity] = frame
+        # Publish the frames only after they are written
+        self.counters[0] = write_count + num_frames
+        return write_count
+
+    def get(self, start, num_frames):
+        """
+        :param start: Write count of the first frame as returned by put
+        :param num_frames: Number of frames
+        :return: list of views of the frames in the shared memory segment. Valid until the frames are released
+        """
+        return [self.frames[(start + i) % self.capacity] for i in range(num_frames)]
+
+    def release(self, num_frames):
+        """
+        Hands the oldest num_frames slots back to the producer
+        :param num_frames: Number of frames
+        :return: None
+        """
+        self.counters[1] += num_frames
+
+    def close(self):
+        # The numpy views must be released before the segment can be closed
+        self.counters = self.frames = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def ingest(descriptor_queue, replay_mem, max_batch=64):
+    """
+    Moves the experience sent by the Actors into the replay memory. Blocks until a descriptor is available and then
+    drains up to max_batch descriptors before blocking again. This runs in the replay memory process so the frames
+    are copied directly from the Actors' shared memory segments into the replay memory.
+    :param descriptor_queue: Queue of [priorities, xp_batch, frame_keys, ring_spec, start] descriptors
+    :param replay_mem: ReplayMemory instance
+    :param max_batch: Maximum number of descriptors handled per wake-up
+    :return: None
+    """
+    rings = dict()
+    while True:
+        descriptors = [descriptor_queue.get()]
+        try:
+            while len(descriptors) < max_batch:
+                descriptors.append(descriptor_queue.get_nowait())
+        except queue.Empty:
+            pass
+        for priorities, xp_batch, frame_keys, ring_spec, start in descriptors:
+            ring = rings.get(ring_spec[0])
+            try:
+                if ring is None:
+                    ring = rings[ring_spec[0]] = SharedFrameRing(ring_spec[1], ring_spec[2], name=ring_spec[0])
+                replay_mem.add(priorities, xp_batch, dict(zip(frame_keys, ring.get(start, len(frame_keys)))))
+            except Exception:
+                # Drop the descriptor but keep ingesting. Otherwise the Actors stall once their rings fill up
+                print("WARNING: Dropped {} transitions sent through {}:".format(len(priorities), ring_spec[0]))
+                traceback.print_exc()
+            finally:
+                if ring is not None:
+                    ring.release(len(frame_keys))
+
+
+def start_ingest_thread(descriptor_queue, replay_mem):
+    """
+    Runs ingest in a daemon thread of the calling process
+    """
+    ingest_thread = threading.Thread(target=ingest, args=(descriptor_queue, replay_mem), daemon=True)
+    ingest_thread.start()
+    return ingest_thread